@@ -0,0 +1,171 @@
+"""Region adjacency graph of a segmentation.
+
+Two cells are neighbours if they share a wall. The watershed marks the walls
+between cells with a line of background voxels, so cells are neighbours if
+their voxels are face neighbours, or are separated by a single background
+voxel, along any axis. The area of the shared wall is the number of such
+voxel pairs.
+
+The graph is built in one vectorised sweep over the face neighbour pairs of
+each axis and stored as a symmetric sparse matrix of wall areas, indexed by
+the position of the cells in the sorted cell identifiers. It is written as a
+.npz archive next to cellinfo.json, so that neighbour statistics can be
+computed without loading the label volume.
+"""
+
+import os
+
+import numpy as np
+import scipy.sparse
+
+from measurements import NEIGHBOUR_MEASUREMENTS
+
+ADJACENCY_FNAME = "adjacency.npz"
+
+
+def adjacency_fpath(info_fpath):
+    """Return path of the adjacency graph written next to a cellinfo file."""
+    return info_fpath[:-len("cellinfo.json")] + ADJACENCY_FNAME
+
+
+def _axis_pairs(labels, axis):
+    """Return (a, b) label arrays of the wall voxel pairs along an axis."""
+    def shifted(start, stop):
+        index = [slice(None)] * labels.ndim
+        index[axis] = slice(start, stop)
+        return labels[tuple(index)]
+
+    size = labels.shape[axis]
+    a, b = shifted(0, size - 1), shifted(1, size)
+    touching = (a != b) & (a != 0) & (b != 0)
+    pairs_a, pairs_b = [a[touching]], [b[touching]]
+    del touching
+
+    if size > 2:
+        a, wall, b = shifted(0, size - 2), shifted(1, size - 1), shifted(2, size)
+        across = (wall == 0) & (a != b) & (a != 0) & (b != 0)
+        pairs_a.append(a[across])
+        pairs_b.append(b[across])
+    return np.concatenate(pairs_a), np.concatenate(pairs_b)
+
+
+def adjacency_graph(labels, identifiers=None):
+    """Return (identifiers, matrix) region adjacency graph of a label volume.
+
+    identifiers is the sorted array of cell identifiers, by default all the
+    non-zero labels, and matrix a symmetric scipy.sparse CSR matrix in which
+    entry (i, j) is the shared wall area of cells identifiers[i] and
+    identifiers[j] in voxels.
+    """
+    labels = np.asarray(labels)
+    if identifiers is None:
+        identifiers = np.unique(labels)
+        identifiers = identifiers[identifiers != 0]
+    identifiers = np.asarray(identifiers)
+    num_cells = len(identifiers)
+
+    keys = []
+    for axis in range(labels.ndim):
+        a, b = _axis_pairs(labels, axis)
+        lo = np.minimum(a, b).astype(np.uint64)
+        hi = np.maximum(a, b).astype(np.uint64)
+        keys.append((lo << np.uint64(32)) | hi)
+    keys, areas = np.unique(np.concatenate(keys), return_counts=True)
+
+    lo = (keys >> np.uint64(32)).astype(np.int64)
+    hi = (keys & np.uint64(0xffffffff)).astype(np.int64)
+    # Pairs with labels that are not among the identifiers are left out.
+    i = np.searchsorted(identifiers, lo)
+    j = np.searchsorted(identifiers, hi)
+    known = (i < num_cells) & (j < num_cells)
+    known[known] &= (identifiers[i[known]] == lo[known]) & \
+        (identifiers[j[known]] == hi[known])
+    i, j, areas = i[known], j[known], areas[known]
+
+    matrix = scipy.sparse.coo_matrix(
+        (np.concatenate([areas, areas]),
+         (np.concatenate([i, j]), np.concatenate([j, i]))),
+        shape=(num_cells, num_cells)).tocsr()
+    return identifiers, matrix
+
+
+def subgraph(identifiers, matrix, keep):
+    """Return (identifiers, matrix) graph restricted to the cells in keep."""
+    keep = np.unique(np.asarray(list(keep), dtype=identifiers.dtype))
+    positions = np.searchsorted(identifiers, keep)
+    found = positions < len(identifiers)
+    found[found] &= identifiers[positions[found]] == keep[found]
+    positions = positions[found]
+    return identifiers[positions], matrix[positions][:, positions].tocsr()
+
+
+def write_adjacency(fpath, identifiers, matrix):
+    """Write adjacency graph to a .npz file."""
+    matrix = matrix.tocsr()
+    tmp_fpath = "{}.{}.tmp".format(fpath, os.getpid())
+    with open(tmp_fpath, "wb") as fh:
+        np.savez_compressed(fh, cell_id=identifiers, data=matrix.data,
+                            indices=matrix.indices, indptr=matrix.indptr,
+                            shape=np.array(matrix.shape))
+    os.rename(tmp_fpath, fpath)
+
+
+def read_adjacency(fpath):
+    """Return (identifiers, matrix) adjacency graph read from a .npz file."""
+    with np.load(fpath) as npz:
+        matrix = scipy.sparse.csr_matrix(
+            (npz["data"], npz["indices"], npz["indptr"]),
+            shape=tuple(npz["shape"]))
+        return npz["cell_id"], matrix
+
+
+def neighbour_mean(matrix, values):
+    """Return wall area weighted mean of the values of the neighbours.
+
+    values holds one value per cell, in the order of the graph. Neighbours
+    with a nan value are left out; cells without such neighbours get nan.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    known = ~np.isnan(values)
+    total_area = matrix.dot(known.astype(np.float64))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return matrix.dot(np.where(known, values, 0.0)) / total_area
+
+
+def neighbour_statistics(cellinfo, identifiers, matrix,
+                         measurements=NEIGHBOUR_MEASUREMENTS):
+    """Return copy of cellinfo with the neighbour statistics of every cell.
+
+    Adds num_neighbours, wall_area, the total area of the walls shared with
+    neighbours, and neighbour_<name>, the wall area weighted mean of a
+    measurement over the neighbours, for every measurement in cellinfo.
+    Cells without neighbours have no neighbour_<name> entries, as JSON has
+    no nan; the CSV and columnar tables treat them as missing values.
+    """
+    positions = np.searchsorted(identifiers,
+                                [props["cell_id"] for props in cellinfo])
+    num_neighbours = np.diff(matrix.indptr)
+    wall_area = np.asarray(matrix.sum(axis=1)).ravel()
+    measurements = [m for m in measurements
+                    if cellinfo and all(m in props for props in cellinfo)]
+
+    means = {}
+    for name in measurements:
+        values = np.full(len(identifiers), np.nan)
+        values[positions] = [props[name] for props in cellinfo]
+        means[name] = neighbour_mean(matrix, values)
+
+    result = []
+    for props, position in zip(cellinfo, positions):
+        props = dict(props)
+        props["num_neighbours"] = int(num_neighbours[position])
+        props["wall_area"] = int(wall_area[position])
+        for name in measurements:
+            value = means[name][position]
+            if np.isnan(value):
+                # Drop any value computed before the neighbours were filtered.
+                props.pop("neighbour_" + name, None)
+            else:
+                props["neighbour_" + name] = float(value)
+        result.append(props)
+    return result
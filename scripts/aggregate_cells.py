@@ -0,0 +1,196 @@
+"""Aggregate the cell tables of all series in an analysis directory.
+
+The output tree is walked to any depth and the per series tables (cells.parquet,
+cells.npz or cells.csv) are read by a pool of worker processes. The tables are
+streamed, in order, into a single typed dataset with the derived genotype,
+treatment and mean_intensity columns also used by all_histograms.R:
+
+- genotype is the part of the series name before the first "_", without any
+  seed bag suffix after a "-"
+- treatment is the second "_" separated part of the file name without the
+  .lif extension
+
+The format of the dataset is given by the extension of the output file:
+.parquet (requires pyarrow), .npz or .csv.
+
+    $ python scripts/aggregate_cells.py output_dir all_cells.parquet
+"""
+
+import os
+import argparse
+import multiprocessing
+from collections import OrderedDict
+
+import numpy as np
+
+from csv import COLUMNS
+from columnar import (
+    find_cells_table,
+    read_cells_table,
+    typed_column,
+    arrow_table,
+    have_pyarrow,
+    write_npz,
+)
+
+DERIVED_COLUMNS = ("genotype", "treatment", "mean_intensity")
+
+OUTPUT_FORMATS = (".parquet", ".npz", ".csv")
+
+
+def genotype(series_name):
+    """Return genotype of a series from its name."""
+    return series_name.split("_")[0].split("-")[0]
+
+
+def treatment(fname):
+    """Return treatment of a series from the name of its microscopy file."""
+    parts = fname.split(".lif")[0].split("_")
+    return parts[1] if len(parts) > 1 else ""
+
+
+def series_directories(directory):
+    """Return sorted list of the directories below directory with a table."""
+    found = []
+    for dirpath, dirnames, fnames in os.walk(directory):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        if find_cells_table(dirpath) is not None:
+            found.append(dirpath)
+    return found
+
+
+def load_series(directory):
+    """Return the table of a series with the derived columns added.
+
+    Measurement columns missing from tables written by older versions are
+    filled with nan, so that all tables have the same columns.
+    """
+    table = read_cells_table(find_cells_table(directory))
+    num_cells = len(table["cell_id"])
+    for name in COLUMNS:
+        if name not in table:
+            table[name] = np.full(num_cells, np.nan)
+    table["genotype"] = typed_column(
+        [genotype(n) for n in table["series_name"]], str)
+    table["treatment"] = typed_column(
+        [treatment(f) for f in table["file"]], str)
+    voxels = table["voxels"].astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        table["mean_intensity"] = table["total_intensity"] / voxels
+    return table
+
+
+class ParquetTableWriter(object):
+    """Append tables to a Parquet file as row groups."""
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self._writer = None
+
+    def write(self, table):
+        import pyarrow.parquet as pq
+        arrow = arrow_table(table)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.fpath, arrow.schema)
+        self._writer.write_table(arrow)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class CSVTableWriter(object):
+    """Append tables to a CSV file with a header."""
+
+    def __init__(self, fpath):
+        self._fh = open(fpath, "w")
+        self._names = None
+
+    def write(self, table):
+        if self._names is None:
+            self._names = list(table.keys())
+            self._fh.write(",".join(self._names) + "\n")
+        columns = [table[name] for name in self._names]
+        for values in zip(*columns):
+            self._fh.write(",".join(str(v) for v in values) + "\n")
+
+    def close(self):
+        self._fh.close()
+
+
+class NPZTableWriter(object):
+    """Collect tables and write their concatenation to a .npz archive."""
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self._tables = []
+
+    def write(self, table):
+        self._tables.append(table)
+
+    def close(self):
+        names = COLUMNS + DERIVED_COLUMNS
+        if self._tables:
+            names = list(self._tables[0].keys())
+        dataset = OrderedDict()
+        for name in names:
+            dataset[name] = np.concatenate([t[name] for t in self._tables]
+                                           if self._tables else [[]])
+        with open(self.fpath, "wb") as fh:
+            write_npz(fh, dataset)
+
+
+def table_writer(fpath):
+    """Return writer for the format given by the extension of fpath."""
+    if fpath.endswith(".parquet"):
+        return ParquetTableWriter(fpath)
+    if fpath.endswith(".npz"):
+        return NPZTableWriter(fpath)
+    return CSVTableWriter(fpath)
+
+
+def aggregate(directory, output_fpath, workers=None):
+    """Write the tables of all series below directory to output_fpath.
+
+    Returns the number of series aggregated.
+    """
+    directories = series_directories(directory)
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    writer = table_writer(output_fpath)
+    pool = multiprocessing.Pool(processes=max(1, min(workers,
+                                                     len(directories))))
+    try:
+        for table in pool.imap(load_series, directories, chunksize=16):
+            writer.write(table)
+    finally:
+        pool.close()
+        pool.join()
+        writer.close()
+    return len(directories)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="Analysis output directory")
+    parser.add_argument("output_file", help="Aggregated dataset")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes (default: number of CPUs)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        parser.error("Not a directory: " + args.directory)
+    if not args.output_file.endswith(OUTPUT_FORMATS):
+        parser.error("Output file must end with one of: {}".format(
+            ", ".join(OUTPUT_FORMATS)))
+    if args.output_file.endswith(".parquet") and not have_pyarrow():
+        parser.error("Writing Parquet requires pyarrow")
+
+    num_series = aggregate(args.directory, args.output_file, args.workers)
+    print("Aggregated {} series into {}".format(num_series,
+                                                args.output_file))
+
+
+if __name__ == "__main__":
+    main()
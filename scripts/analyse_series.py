@@ -9,36 +9,129 @@ from jicbioimage.core.io import AutoName, AutoWrite
 from jicbioimage.segment import SegmentedImage
 from jicbioimage.core.image import Image3D
 
-from setup_image_data import get_data_manager
-from utils import ColorImage3D
-from segment import segment, identity
+from setup_image_data import zstack_channels
+from backend import hash_cache_fpath, load_microscopy_collection
+from utils import ColorImage3D, load_istack
+from labelvolume import LABEL_VOLUME_EXT
+from segment import segment, identity, set_itk_threads, MASK_HULLS
+from blockwise import segment_blockwise, DEFAULT_OVERLAP
 from cellinfo import cellinfo
-from filter_real_cells import filter_by_property, real_cells
-from create_intensity_stack import (
-    create_mean_intensity_stack,
-    create_total_intensity_stack,
+from adjacency import (
+    adjacency_graph,
+    adjacency_fpath,
+    neighbour_statistics,
+    read_adjacency,
+    subgraph,
+    write_adjacency,
 )
+from filter_real_cells import filter_by_property, real_cells
+from create_intensity_stack import create_mean_and_total_intensity_stacks
 from csv import csv
-from histogram import generate_histogram
-from omexml import OmeXml
+from columnar import (
+    cells_table,
+    have_pyarrow,
+    write_cells_table,
+    CELLS_CSV_FNAME,
+    CELLS_NPZ_FNAME,
+    CELLS_PARQUET_FNAME,
+)
+from histogram import (
+    generate_histogram,
+    MEAN_HISTOGRAM_FNAME,
+    SUM_HISTOGRAM_FNAME,
+)
+from omexml import get_omexml, OMEXML_CACHE_DIRNAME
+from manifest import (
+    create_manifest,
+    file_hash,
+    write_manifest,
+    remove_manifest,
+)
+from pipeline import Pipeline
+from cache import StageCache
+from stackwriter import StackWriterConfig, FORMAT_EXTENSIONS
+from profiling import (
+    start_profile,
+    stop_profile,
+    profile_stage,
+    record_output,
+    PROFILE_FNAME,
+)
+
+__version__ = "0.4.0"
+
+# Results cached by other versions of the pipeline are not reused.
+StageCache.version = __version__
 
-__version__ = "0.2.0"
+DEFAULT_PARAMETERS = {"watershed_level": 0.664,
+                      "min_cell_size": 10000,
+                      "max_cell_size": 80000,
+                      "mask_hull": "plane"}
 
 AutoName.prefix_format = "{:03d}_"
 
 
-def create_istack(segmentation, info, output_dir, name):
-    istack_fname = name + ".istack"
-    istack_output_dir = os.path.join(output_dir, istack_fname)
-    segmentation.view(ColorImage3D).to_directory(istack_output_dir)
-    info_fpath = os.path.join(istack_output_dir, "cellinfo.json")
+def istack_fpaths(output_dir, name, png=True):
+    """Return (volume_fpath, info_fpath) written by create_istack."""
+    volume_fpath = os.path.join(output_dir, name + LABEL_VOLUME_EXT)
+    if png:
+        info_fpath = os.path.join(output_dir, name + ".istack", "cellinfo.json")
+    else:
+        info_fpath = os.path.join(output_dir, name + "_cellinfo.json")
+    return volume_fpath, info_fpath
+
+
+def create_istack(segmentation, info, output_dir, name, png=True):
+    """Write segmentation and cell info to disk.
+
+    The segmentation is always written as a label volume file with the cell
+    info embedded. If png is True it is also written as an istack directory
+    of unique colour PNG z-slices.
+    """
+    volume_fpath, info_fpath = istack_fpaths(output_dir, name, png)
+    segmentation.view(ColorImage3D).to_label_volume(volume_fpath, info)
+    if png:
+        segmentation.view(ColorImage3D).to_directory(
+            os.path.dirname(info_fpath))
     with open(info_fpath, "w") as fh:
         json.dump(info, fh, indent=2)
-    return istack_output_dir, info_fpath
+    return volume_fpath, info_fpath
+
+
+def load_channels(microscopy_collection, series, low_memory=False):
+    """Return (wall_stack, intensity_stack) of a series.
+
+    Both channels are read from the backend in a single parallel pass, and
+    memory mapped from it if low_memory is True.
+    """
+    stacks = zstack_channels(microscopy_collection, s=series,
+                             channels=(1, 0), low_memory=low_memory)
+    if AutoWrite.on:
+        # Write the input channels out in debug mode.
+        return identity(stacks[1]), identity(stacks[0])
+    return stacks[1], stacks[0]
 
 
 def analyse_series(microscopy_collection, input_fname, series, series_name,
-                   output_directory):
+                   output_directory, parameters=None, png_istacks=True,
+                   low_memory=False, tiling=None, input_hash=None):
+    """Analyse a series.
+
+    In low memory mode the channels are memory mapped from the backend
+    rather than loaded into memory. In both modes intermediate images are
+    released as soon as possible. Each step is run as a profiling stage.
+
+    If tiling is a (tile_shape, overlap) tuple the stack is segmented tile
+    by tile, see blockwise.py.
+
+    The analysis is run as an incremental pipeline, see pipeline.py. If
+    input_hash, the hash of the content of the input file, is given, stages
+    whose input and parameters are unchanged since the last analysis in
+    output_directory are not run again. Changing the cell size limits, for
+    example, only reruns the filtering and the stages after it.
+    """
+    if parameters is None:
+        parameters = DEFAULT_PARAMETERS
 
     # Write series identifier to disk.
     series_id_fname = os.path.join(output_directory, "series_id.txt")
@@ -50,74 +143,211 @@ def analyse_series(microscopy_collection, input_fname, series, series_name,
     with open(series_name_fname, "w") as fh:
         fh.write("{}\n".format(series_name))
 
-    # Segment root into cells.
-    stack = microscopy_collection.zstack(s=series, c=1)
-    stack = identity(stack)
-    stack = segment(stack)
-    segmented_cells = stack.view(SegmentedImage)
-    num_cells = len(segmented_cells.identifiers)
-    logging.info("Root segmented into {} cells".format(num_cells))
-
-    # Calculate cell info and write to disk.
-    intensity_stack = microscopy_collection.zstack(s=series, c=0)
-    intensity_stack = identity(intensity_stack)
-    info = cellinfo(intensity_stack, segmented_cells)
-
-    # Create segmented istack.
-    create_istack(segmented_cells, info, output_directory, "segmented")
-
-    # Filter cells.
-    min_cell_size = 10000
-    max_cell_size = 80000
-    logging.info("Filter cells < {} voxels".format(min_cell_size))
-    logging.info("Filter cells > {} voxels".format(max_cell_size))
-    filtered_cells, filtered_info = filter_by_property(segmented_cells,
-                                                       info,
-                                                       real_cells,
-                                                       min_cell_size,
-                                                       max_cell_size)
-    filtered_istack_dir, filtered_info_fpath = create_istack(filtered_cells,
-                                                             filtered_info,
-                                                             output_directory,
-                                                             "filtered")
-    num_cells = len(filtered_cells.identifiers)
-    logging.info("Post filter {} cells remain".format(num_cells))
-
-    # Create intensity stacks.
-    create_mean_intensity_stack(filtered_cells,
-                           filtered_info,
-                           os.path.join(output_directory, "mean_intensity.stack"))
-    create_total_intensity_stack(filtered_cells,
-                           filtered_info,
-                           os.path.join(output_directory, "total_intensity.stack"))
-
-    # Write csv.
-    csv_text = csv(input_fname, series_name, series, filtered_info)
-    with open(os.path.join(output_directory, "cells.csv"), "w") as fh:
-        fh.write(csv_text)
-
-    # Generate histogram.
-    mean_hist_fpath = os.path.join(output_directory,
-                                   "mean_intensity_histogram.png")
-    sum_hist_fpath = os.path.join(output_directory,
-                                  "sum_intensity_histogram.png")
-    return_code = generate_histogram(filtered_info_fpath,
-                                     mean_hist_fpath,
-                                     sum_hist_fpath)
-    if not int(return_code) == 0:
-        logging.warning("Failed to generate histogram")
-    else:
-        logging.info("Generated mean intensity histogram: {}".format(mean_hist_fpath))
-        logging.info("Generated sum intensity histogram: {}".format(sum_hist_fpath))
-
-
-def analyse_file(fpath, output_directory, series, backend_directory):
-    """Analyse a single file."""
+    segmented_volume_fpath, segmented_info_fpath = istack_fpaths(
+        output_directory, "segmented", png_istacks)
+    filtered_volume_fpath, filtered_info_fpath = istack_fpaths(
+        output_directory, "filtered", png_istacks)
+    mean_stack_dir = os.path.join(output_directory, "mean_intensity.stack")
+    total_stack_dir = os.path.join(output_directory, "total_intensity.stack")
+    table_fname = CELLS_PARQUET_FNAME if have_pyarrow() else CELLS_NPZ_FNAME
+    mean_hist_fpath = os.path.join(output_directory, MEAN_HISTOGRAM_FNAME)
+    sum_hist_fpath = os.path.join(output_directory, SUM_HISTOGRAM_FNAME)
+
+    def run_load_channels():
+        # Read both channels in one pass.
+        with profile_stage("load_channels"):
+            return list(load_channels(microscopy_collection, series,
+                                      low_memory))
+
+    def run_segment(channels):
+        # Take the stacks out of the channels result so that deleting them
+        # below frees them.
+        intensity_stack = channels.pop()
+        wall_stack = channels.pop()
+
+        # Segment root into cells.
+        with profile_stage("segment") as record:
+            if tiling is None:
+                stack = segment(wall_stack, parameters["watershed_level"],
+                                parameters["mask_hull"])
+            else:
+                tile_shape, overlap = tiling
+                stack = segment_blockwise(wall_stack,
+                                          parameters["watershed_level"],
+                                          tile_shape, overlap,
+                                          hull=parameters["mask_hull"])
+            segmented_cells = stack.view(SegmentedImage)
+            record_output(record, segmented_cells)
+            del stack
+        num_cells = len(segmented_cells.identifiers)
+        logging.info("Root segmented into {} cells".format(num_cells))
+
+        # Calculate cell info.
+        with profile_stage("cellinfo"):
+            info = cellinfo(intensity_stack, segmented_cells,
+                            channels={0: intensity_stack, 1: wall_stack})
+            del intensity_stack, wall_stack
+
+        # Build the region adjacency graph of the cells.
+        with profile_stage("adjacency"):
+            cell_ids, graph = adjacency_graph(
+                segmented_cells, sorted(props["cell_id"] for props in info))
+            info = neighbour_statistics(info, cell_ids, graph)
+
+        # Create segmented istack.
+        with profile_stage("segmented_istack"):
+            create_istack(segmented_cells, info, output_directory,
+                          "segmented", png_istacks)
+            write_adjacency(adjacency_fpath(segmented_info_fpath), cell_ids,
+                            graph)
+        return segmented_cells, info, cell_ids, graph
+
+    def load_segment():
+        with profile_stage("load_segmented"):
+            segmented_cells, info = load_istack(segmented_volume_fpath)
+            cell_ids, graph = read_adjacency(
+                adjacency_fpath(segmented_info_fpath))
+        return segmented_cells.view(SegmentedImage), info, cell_ids, graph
+
+    def run_filter(segmentation):
+        segmented_cells, info, cell_ids, graph = segmentation
+        min_cell_size = parameters["min_cell_size"]
+        max_cell_size = parameters["max_cell_size"]
+        logging.info("Filter cells < {} voxels".format(min_cell_size))
+        logging.info("Filter cells > {} voxels".format(max_cell_size))
+        with profile_stage("filter"):
+            filtered_cells, filtered_info = filter_by_property(segmented_cells,
+                                                               info,
+                                                               real_cells,
+                                                               min_cell_size,
+                                                               max_cell_size)
+            del segmented_cells
+            # Neighbours that were filtered out no longer count.
+            cell_ids, graph = subgraph(
+                cell_ids, graph, [props["cell_id"] for props in filtered_info])
+            filtered_info = neighbour_statistics(filtered_info, cell_ids, graph)
+        with profile_stage("filtered_istack"):
+            create_istack(filtered_cells, filtered_info, output_directory,
+                          "filtered", png_istacks)
+            write_adjacency(adjacency_fpath(filtered_info_fpath), cell_ids,
+                            graph)
+        num_cells = len(filtered_cells.identifiers)
+        logging.info("Post filter {} cells remain".format(num_cells))
+        return filtered_cells, filtered_info
+
+    def load_filter():
+        with profile_stage("load_filtered"):
+            filtered_cells, filtered_info = load_istack(filtered_volume_fpath)
+        return filtered_cells.view(SegmentedImage), filtered_info
+
+    def run_intensity_stacks(filtered):
+        filtered_cells, filtered_info = filtered
+        with profile_stage("intensity_stacks"):
+            create_mean_and_total_intensity_stacks(
+                filtered_cells,
+                filtered_info,
+                mean_stack_dir,
+                total_stack_dir)
+
+    def run_csv(filtered):
+        # Write csv and typed columnar table.
+        _, filtered_info = filtered
+        with profile_stage("csv"):
+            csv_text = csv(input_fname, series_name, series, filtered_info)
+            with open(os.path.join(output_directory, CELLS_CSV_FNAME),
+                      "w") as fh:
+                fh.write(csv_text)
+            write_cells_table(cells_table(input_fname, series_name, series,
+                                          filtered_info),
+                              output_directory)
+
+    def run_histogram(filtered):
+        _, filtered_info = filtered
+        with profile_stage("histogram"):
+            return_code = generate_histogram(filtered_info_fpath,
+                                             mean_hist_fpath,
+                                             sum_hist_fpath,
+                                             filtered_info)
+        if not int(return_code) == 0:
+            logging.warning("Failed to generate histogram")
+        else:
+            logging.info("Generated mean intensity histogram: {}".format(mean_hist_fpath))
+            logging.info("Generated sum intensity histogram: {}".format(sum_hist_fpath))
+
+    def relative(*fpaths):
+        return [os.path.relpath(f, output_directory) for f in fpaths]
+
+    pipeline = Pipeline(output_directory if input_hash is not None else None,
+                        __version__)
+    pipeline.add("channels", run_load_channels,
+                 parameters={"input_hash": input_hash, "series": series})
+    pipeline.add("segment", run_segment, depends=["channels"],
+                 parameters={"watershed_level": parameters["watershed_level"],
+                             "mask_hull": parameters["mask_hull"],
+                             "tiling": tiling,
+                             "png_istacks": png_istacks,
+                             "stack_format": StackWriterConfig.format},
+                 outputs=relative(segmented_volume_fpath, segmented_info_fpath,
+                                  adjacency_fpath(segmented_info_fpath)),
+                 load=load_segment)
+    pipeline.add("filter", run_filter, depends=["segment"],
+                 parameters={"min_cell_size": parameters["min_cell_size"],
+                             "max_cell_size": parameters["max_cell_size"],
+                             "png_istacks": png_istacks,
+                             "stack_format": StackWriterConfig.format},
+                 outputs=relative(filtered_volume_fpath, filtered_info_fpath,
+                                  adjacency_fpath(filtered_info_fpath)),
+                 load=load_filter)
+    pipeline.add("intensity_stacks", run_intensity_stacks, depends=["filter"],
+                 parameters={"stack_format": StackWriterConfig.format},
+                 outputs=relative(mean_stack_dir, total_stack_dir))
+    pipeline.add("csv", run_csv, depends=["filter"],
+                 parameters={"file": input_fname,
+                             "series_name": series_name,
+                             "series_id": series},
+                 outputs=[CELLS_CSV_FNAME, table_fname])
+    pipeline.add("histogram", run_histogram, depends=["filter"],
+                 outputs=relative(mean_hist_fpath, sum_hist_fpath))
+    pipeline.run()
+
+
+def analyse_file(fpath, output_directory, series, backend_directory,
+                 parameters=None, png_istacks=True, low_memory=False,
+                 tiling=None):
+    """Analyse a single file.
+
+    The profile of the analysis is written to profile.json in the output
+    directory. A completion manifest is written to the output directory once
+    the analysis has finished; any existing manifest is removed beforehand so
+    that a partially rewritten directory is never mistaken for a complete one.
+    Stages of an earlier analysis of the series that are still current are
+    reused, see analyse_series.
+    """
+    if parameters is None:
+        parameters = DEFAULT_PARAMETERS
+    remove_manifest(output_directory)
+    profile = start_profile()
+    try:
+        _analyse_file(fpath, output_directory, series, backend_directory,
+                      parameters, png_istacks, low_memory, tiling)
+    finally:
+        stop_profile()
+        profile.write(os.path.join(output_directory, PROFILE_FNAME))
+
+    write_manifest(output_directory,
+                   create_manifest(fpath, series, __version__, parameters,
+                                   hash_cache_fpath(backend_directory)))
+
+
+def _analyse_file(fpath, output_directory, series, backend_directory,
+                  parameters, png_istacks, low_memory, tiling):
     logging.info("Analysing file: {}".format(fpath))
     logging.info("Series identifier: {}".format(series))
-    data_manager = get_data_manager(backend_directory)
-    microscopy_collection = data_manager.load(fpath)
-    omexml = OmeXml(fpath)
+    with profile_stage("load"):
+        microscopy_collection = load_microscopy_collection(fpath,
+                                                           backend_directory)
+        omexml = get_omexml(fpath, os.path.join(backend_directory,
+                                                OMEXML_CACHE_DIRNAME))
 
     series_name = omexml.series(series).name
     logging.info("Series name: {}".format(series_name))
@@ -126,7 +356,13 @@ def analyse_file(fpath, output_directory, series, backend_directory):
                    os.path.basename(fpath),
                    series,
                    series_name,
-                   output_directory)
+                   output_directory,
+                   parameters,
+                   png_istacks,
+                   low_memory,
+                   tiling,
+                   input_hash=file_hash(
+                       fpath, cache_fpath=hash_cache_fpath(backend_directory)))
 
 
 def main():
@@ -137,6 +373,41 @@ def main():
     parser.add_argument("output_dir", help="Output directory")
     parser.add_argument("--debug", default=False, action="store_true",
                         help="Write out intermediate images")
+    parser.add_argument("--no-png-istacks", default=False,
+                        action="store_true",
+                        help="Only write segmentations as label volumes")
+    parser.add_argument("--low-memory", default=False, action="store_true",
+                        help="Memory map the channels from the backend")
+    parser.add_argument("--tile-size", type=int, nargs=2, default=None,
+                        metavar=("Y", "X"),
+                        help="Segment the stack in tiles of this size")
+    parser.add_argument("--tile-overlap", type=int, default=DEFAULT_OVERLAP,
+                        help="Overlap between tiles in voxels")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Cache intermediate segmentation stages here")
+    parser.add_argument("--cache-size", type=float, default=10,
+                        help="Maximum size of the stage cache in GB")
+    parser.add_argument("--stack-format", default="png",
+                        choices=sorted(FORMAT_EXTENSIONS),
+                        help="Image format of the z-slices in stacks")
+    parser.add_argument("--png-compression", type=int, default=6,
+                        choices=range(10), metavar="{0-9}",
+                        help="zlib compression level of PNG z-slices")
+    parser.add_argument("--writer-workers", type=int, default=None,
+                        help="Number of threads encoding z-slices")
+    parser.add_argument("--watershed-level", type=float,
+                        default=DEFAULT_PARAMETERS["watershed_level"],
+                        help="Watershed level of the segmentation")
+    parser.add_argument("--min-cell-size", type=int,
+                        default=DEFAULT_PARAMETERS["min_cell_size"],
+                        help="Filter out cells with fewer voxels")
+    parser.add_argument("--max-cell-size", type=int,
+                        default=DEFAULT_PARAMETERS["max_cell_size"],
+                        help="Filter out cells with more voxels")
+    parser.add_argument("--mask-hull", default="plane", choices=MASK_HULLS,
+                        help="Convex hull of the root mask per z-slice or in 3D")
+    parser.add_argument("--itk-threads", type=int, default=None,
+                        help="Number of SimpleITK filter threads")
     args = parser.parse_args()
 
     if not os.path.isfile(args.input_source):
@@ -163,6 +434,18 @@ def main():
     if not args.debug:
         AutoWrite.on = False
 
+    # Configure how stacks of z-slices are written.
+    StackWriterConfig.format = args.stack_format
+    StackWriterConfig.compression_level = args.png_compression
+    StackWriterConfig.workers = args.writer_workers
+
+    set_itk_threads(args.itk_threads)
+
+    # Reuse intermediate segmentation stages between runs.
+    if args.cache_dir is not None:
+        StageCache.directory = args.cache_dir
+        StageCache.max_bytes = int(args.cache_size * 2**30)
+
     # Setup a logger for the script.
     log_fname = "audit.log"
     log_fpath = os.path.join(output_dir, log_fname)
@@ -175,8 +458,21 @@ def main():
     logging.info("Script name: {}".format(__file__))
     logging.info("Script version: {}".format(__version__))
 
+    tiling = None
+    if args.tile_size is not None:
+        tiling = (tuple(args.tile_size), args.tile_overlap)
+
     # Run the analysis.
-    analyse_file(args.input_source, output_dir, args.series, backend_dir)
+    parameters = dict(DEFAULT_PARAMETERS,
+                      watershed_level=args.watershed_level,
+                      min_cell_size=args.min_cell_size,
+                      max_cell_size=args.max_cell_size,
+                      mask_hull=args.mask_hull)
+    analyse_file(args.input_source, output_dir, args.series, backend_dir,
+                 parameters=parameters,
+                 png_istacks=not args.no_png_istacks,
+                 low_memory=args.low_memory,
+                 tiling=tiling)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,193 @@
+"""Shared backend of unpacked microscopy files.
+
+Microscopy files are converted by jicbioimage into a backend directory of
+TIFF files, one entry directory per input file named after the MD5 digest of
+its contents. This module makes sure that each input is unpacked exactly
+once, however many processes or hosts load it at the same time:
+
+- an input whose entry has a manifest is loaded without locking
+- otherwise the process takes an exclusive lock on the entry, and processes
+  that load the same input wait for it to be released and then reuse the
+  entry
+- the input is converted into a temporary directory inside the backend and
+  the entry is moved into place with an atomic rename, so that a partially
+  unpacked entry is never visible
+
+The digests of the input files are stored in the backend directory, keyed by
+path, size and modification time, so that an unchanged input is only hashed
+once.
+
+Entries of inputs that are no longer analysed can be removed:
+
+    $ python scripts/backend.py output_dir input_dir
+"""
+
+import os
+import fcntl
+import shutil
+import logging
+import argparse
+import tempfile
+import contextlib
+
+from jicbioimage.core.io import FileBackend, BFConvertWrapper
+from jicbioimage.core.image import MicroscopyCollection
+
+from manifest import file_hash
+
+BACKEND_DIRNAME = ".backend"
+LOCK_DIRNAME = ".locks"
+GC_LOCK_FNAME = "gc.lock"
+ENTRY_MANIFEST_FNAME = "manifest.json"
+HASH_CACHE_FNAME = "hashes.json"
+UNPACK_PREFIX = ".unpack-"
+
+_COLLECTIONS = {}
+
+
+def backend_directory(output_directory):
+    """Return path of the backend directory of an output directory."""
+    return os.path.join(output_directory, BACKEND_DIRNAME)
+
+
+def hash_cache_fpath(output_directory):
+    """Return path of the file storing the digests of the input files."""
+    return os.path.join(backend_directory(output_directory), HASH_CACHE_FNAME)
+
+
+def entry_name(fpath, backend_dir):
+    """Return name of the backend entry of an input file."""
+    # jicbioimage names entries after the MD5 digest of the file.
+    return file_hash(fpath, algorithm="md5",
+                     cache_fpath=os.path.join(backend_dir, HASH_CACHE_FNAME))
+
+
+def _makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError:
+        if not os.path.isdir(directory):
+            raise
+
+
+@contextlib.contextmanager
+def file_lock(fpath, shared=False):
+    """Context manager holding an advisory lock on a lock file.
+
+    Blocks until the lock is acquired.
+    """
+    _makedirs(os.path.dirname(fpath))
+    with open(fpath, "a") as fh:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+
+def _lock_fpath(backend_dir, name):
+    return os.path.join(backend_dir, LOCK_DIRNAME, name + ".lock")
+
+
+def unpack(fpath, backend_dir):
+    """Unpack an input file into the backend once; return its manifest path."""
+    name = entry_name(fpath, backend_dir)
+    entry_dir = os.path.join(backend_dir, name)
+    manifest_fpath = os.path.join(entry_dir, ENTRY_MANIFEST_FNAME)
+    if os.path.isfile(manifest_fpath):
+        return manifest_fpath
+
+    # The shared lock keeps the garbage collector out while unpacking.
+    with file_lock(os.path.join(backend_dir, LOCK_DIRNAME, GC_LOCK_FNAME),
+                   shared=True):
+        with file_lock(_lock_fpath(backend_dir, name)):
+            if os.path.isfile(manifest_fpath):
+                logging.info("Reusing unpacked {}".format(fpath))
+                return manifest_fpath
+
+            logging.info("Unpacking {}".format(fpath))
+            if os.path.isdir(entry_dir):
+                # Left behind by an unpack without this module.
+                shutil.rmtree(entry_dir)
+            tmp_dir = tempfile.mkdtemp(prefix=UNPACK_PREFIX, dir=backend_dir)
+            try:
+                BFConvertWrapper(FileBackend(tmp_dir))(fpath)
+                os.rename(os.path.join(tmp_dir, name), entry_dir)
+            finally:
+                shutil.rmtree(tmp_dir)
+    return manifest_fpath
+
+
+def load_microscopy_collection(fpath, output_directory):
+    """Return MicroscopyCollection of an input, unpacking it if needed.
+
+    Collections are cached per process.
+    """
+    backend_dir = backend_directory(output_directory)
+    _makedirs(backend_dir)
+    manifest_fpath = unpack(fpath, backend_dir)
+    if manifest_fpath not in _COLLECTIONS:
+        _COLLECTIONS[manifest_fpath] = MicroscopyCollection(manifest_fpath)
+    return _COLLECTIONS[manifest_fpath]
+
+
+def input_files(paths):
+    """Return list of the files given, and of the files in the directories."""
+    fpaths = []
+    for path in paths:
+        if os.path.isdir(path):
+            fpaths.extend(os.path.join(path, f) for f in sorted(os.listdir(path))
+                          if os.path.isfile(os.path.join(path, f)))
+        else:
+            fpaths.append(path)
+    return fpaths
+
+
+def collect_garbage(output_directory, input_fpaths, dry_run=False):
+    """Remove backend entries of files that are not in input_fpaths.
+
+    Also removes temporary directories of unpacks that did not finish. Waits
+    for unpacks in progress to finish first. Returns list of the removed
+    paths.
+    """
+    backend_dir = backend_directory(output_directory)
+    if not os.path.isdir(backend_dir):
+        return []
+    referenced = set(entry_name(f, backend_dir) for f in input_fpaths)
+    removed = []
+    with file_lock(os.path.join(backend_dir, LOCK_DIRNAME, GC_LOCK_FNAME)):
+        for name in sorted(os.listdir(backend_dir)):
+            path = os.path.join(backend_dir, name)
+            if not os.path.isdir(path):
+                continue
+            unfinished = name.startswith(UNPACK_PREFIX)
+            if not unfinished and (name.startswith(".") or name in referenced):
+                continue
+            removed.append(path)
+            if not dry_run:
+                shutil.rmtree(path)
+                lock_fpath = _lock_fpath(backend_dir, name)
+                if os.path.isfile(lock_fpath):
+                    os.unlink(lock_fpath)
+    _COLLECTIONS.clear()
+    return removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("output_directory", help="Analysis output directory")
+    parser.add_argument("inputs", nargs="+",
+                        help="Input files, or directories of input files, "
+                             "whose backend entries are kept")
+    parser.add_argument("--dry-run", default=False, action="store_true",
+                        help="List the entries without removing them")
+    args = parser.parse_args()
+
+    for path in collect_garbage(args.output_directory,
+                                input_files(args.inputs), args.dry_run):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
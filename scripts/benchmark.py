@@ -0,0 +1,175 @@
+"""Benchmark the pipeline stages on a synthetic root phantom.
+
+Runs fully offline: the input is a Voronoi cell phantom generated at the
+requested size. Each stage is timed, taking the best of several repeats, and
+its throughput and peak memory are reported. The share of the cells of the
+whole volume segmentation that the blockwise segmentation finds is reported
+too. Results can be stored as a baseline and later runs compared against it.
+
+    $ python scripts/benchmark.py --shape 256 256 32 --cells 200 --save-baseline baseline.json
+    $ python scripts/benchmark.py --shape 256 256 32 --cells 200 --baseline baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+from jicbioimage.core.io import AutoWrite
+from jicbioimage.segment import SegmentedImage
+
+from phantom import root_phantom, PhantomCollection
+from segment import segment
+from blockwise import segment_blockwise, label_agreement
+from cellinfo import cellinfo
+from filter_real_cells import filter_by_property, real_cells
+from create_intensity_stack import create_mean_and_total_intensity_stacks
+from labelvolume import write_label_volume
+from utils import ColorImage3D
+from memory import peak_rss, reset_peak_rss
+from analyse_series import analyse_series, DEFAULT_PARAMETERS
+
+
+def time_stage(func, repeat):
+    """Return (best wall time, peak RSS, result) of calling func repeatedly."""
+    best = None
+    peak = 0
+    result = None
+    for _ in range(repeat):
+        reset_peak_rss()
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        peak = max(peak, peak_rss())
+        best = elapsed if best is None else min(best, elapsed)
+    return best, peak, result
+
+
+def run_benchmarks(shape, num_cells, seed, repeat, workdir):
+    """Return dictionary of results per stage."""
+    wall, intensity, _ = root_phantom(shape, num_cells, seed)
+    num_voxels = wall.size
+    results = {}
+
+    def record(name, func):
+        wall_time, peak, result = time_stage(func, repeat)
+        results[name] = {"wall_time": wall_time,
+                         "peak_rss": peak,
+                         "mvoxels_per_second": num_voxels / wall_time / 1e6}
+        return result
+
+    segmentation = record("segment", lambda: segment(wall.copy()))
+    segmentation = segmentation.view(SegmentedImage)
+    # Check the stitched tiles against the whole volume segmentation.
+    tile_shape = (max(1, shape[0] // 2), max(1, shape[1] // 2))
+    blockwise = record("segment_blockwise",
+                       lambda: segment_blockwise(wall.copy(),
+                                                 tile_shape=tile_shape))
+    results["segment_blockwise"]["agreement"] = label_agreement(segmentation,
+                                                                blockwise)
+    info = record("cellinfo", lambda: cellinfo(intensity, segmentation))
+    filtered, filtered_info = record(
+        "filter_by_property",
+        lambda: filter_by_property(segmentation.copy(), info, real_cells,
+                                   DEFAULT_PARAMETERS["min_cell_size"],
+                                   DEFAULT_PARAMETERS["max_cell_size"]))
+    record("istack_png",
+           lambda: filtered.view(ColorImage3D).to_directory(
+               os.path.join(workdir, "filtered.istack")))
+    record("label_volume",
+           lambda: write_label_volume(os.path.join(workdir, "filtered.lvol"),
+                                      filtered, filtered_info))
+    record("intensity_stacks",
+           lambda: create_mean_and_total_intensity_stacks(
+               filtered, filtered_info,
+               os.path.join(workdir, "mean_intensity.stack"),
+               os.path.join(workdir, "total_intensity.stack")))
+
+    def end_to_end():
+        output_dir = os.path.join(workdir, "analyse_series")
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        os.mkdir(output_dir)
+        analyse_series(PhantomCollection(wall, intensity), "phantom.lif", 0,
+                       "phantom", output_dir)
+    record("analyse_series", end_to_end)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return list of stages that are slower than baseline by tolerance."""
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = result["wall_time"] / baseline[name]["wall_time"]
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+        print("{:<20} {:>6.2f}x baseline".format(name, ratio))
+    return regressions
+
+
+def print_results(results):
+    print("{:<20} {:>10} {:>12} {:>12}".format("stage", "time (s)",
+                                               "Mvoxel/s", "peak RSS MB"))
+    for name, result in sorted(results.items()):
+        print("{:<20} {:>10.3f} {:>12.2f} {:>12.1f}".format(
+            name, result["wall_time"], result["mvoxels_per_second"],
+            result["peak_rss"] / 2.0**20))
+    if "segment_blockwise" in results:
+        print("Blockwise segmentation finds {:.1%} of the cells of the "
+              "whole volume segmentation".format(
+                  results["segment_blockwise"]["agreement"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shape", type=int, nargs=3, default=[256, 256, 32],
+                        metavar=("Y", "X", "Z"), help="Phantom shape")
+    parser.add_argument("--cells", type=int, default=200,
+                        help="Number of Voronoi cells")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of times each stage is run")
+    parser.add_argument("--baseline", help="Baseline JSON to compare against")
+    parser.add_argument("--save-baseline", help="Write results as baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed slow down relative to the baseline")
+    args = parser.parse_args()
+
+    AutoWrite.on = False
+    logging.basicConfig(level=logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix="root-3d-benchmark-")
+    try:
+        results = run_benchmarks(args.shape, args.cells, args.seed,
+                                 args.repeat, workdir)
+    finally:
+        shutil.rmtree(workdir)
+
+    print_results(results)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as fh:
+            json.dump({"shape": args.shape, "cells": args.cells,
+                       "stages": results}, fh, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if baseline["shape"] != args.shape or baseline["cells"] != args.cells:
+            parser.error("Baseline was recorded for a different phantom")
+        regressions = compare(results, baseline["stages"], args.tolerance)
+        if regressions:
+            print("Regressions: {}".format(", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""Blockwise segmentation of stacks too large to preprocess in one go.
+
+The stack is split into tiles in the y and x dimensions. Each tile is
+extended by an overlap on every side, which must be at least the combined
+footprint of the median, gradient magnitude and Gaussian filters
+(FILTER_HALO), so that the preprocessing of the tile core is identical to a
+whole volume run. The tiles are preprocessed and segmented by the watershed
+in parallel worker processes.
+
+The tile segmentations are stitched in raster order. Each tile label gets a
+provisional identifier and is matched against the provisional identifiers
+already written by its neighbours in the overlap: labels that share most of
+their voxels there are the same cell and their identifiers are joined in a
+union-find structure. The core of the tile is then written to the global
+label volume. Once all tiles are written every cell is given the identifier
+of its joined set, so that cells crossing tile boundaries keep one identity
+even if earlier tiles split them.
+
+Unlike the preprocessing, the watershed is not local: the flooding of a tile
+only sees the tile. Cells wider than the overlap, and walls near the tile
+borders, can therefore differ from a whole volume run. Stitching reconciles
+the identities of the cells, not their boundaries. label_agreement measures
+the difference, and benchmark.py reports it for a phantom.
+
+The root mask is computed for the whole stack, since it only requires
+boolean images, and the mask and border filters are applied to the stitched
+segmentation.
+"""
+
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from jicbioimage.core.image import Image3D
+from jicbioimage.core.io import AutoWrite
+
+from segment import (
+    set_itk_threads,
+    generate_mask,
+    preprocess,
+    morphological_watershed,
+    filter_segmented,
+)
+from utils import ColorImage3D
+from profiling import profile_stage
+
+# Median radius 1, gradient magnitude 1 and Gaussian with variance 2, whose
+# kernel is truncated at roughly three standard deviations.
+FILTER_HALO = 1 + 1 + 5
+
+DEFAULT_TILE_SHAPE = (512, 512)
+DEFAULT_OVERLAP = 32
+
+# Stack shared with the worker processes, set by the pool initializer.
+_SHARED = {}
+
+
+def tiles(shape, tile_shape, overlap):
+    """Return list of (outer, core, core_in_outer) tuples of slices.
+
+    Tiles only split the y and x dimensions. core is the region of the stack
+    a tile is responsible for, outer the core extended by the overlap.
+    core_in_outer gives the position of the core within the outer region.
+    """
+    result = []
+    ranges = []
+    for size, tile_size in zip(shape[:2], tile_shape):
+        ranges.append([(start, min(start + tile_size, size))
+                       for start in range(0, size, tile_size)])
+    for (y0, y1), (x0, x1) in itertools.product(*ranges):
+        oy0, oy1 = max(y0 - overlap, 0), min(y1 + overlap, shape[0])
+        ox0, ox1 = max(x0 - overlap, 0), min(x1 + overlap, shape[1])
+        outer = (slice(oy0, oy1), slice(ox0, ox1), slice(None))
+        core = (slice(y0, y1), slice(x0, x1), slice(None))
+        core_in_outer = (slice(y0 - oy0, y1 - oy0),
+                         slice(x0 - ox0, x1 - ox0),
+                         slice(None))
+        result.append((outer, core, core_in_outer))
+    return result
+
+
+def _init_worker(itk_threads, shared):
+    """Configure a freshly started worker process.
+
+    The stack reaches the workers as an initializer argument, which forked
+    workers inherit without copying and spawned workers unpickle once.
+    """
+    AutoWrite.on = False
+    set_itk_threads(itk_threads)
+    _SHARED.update(shared)
+
+
+def _segment_tile(task):
+    """Return (index, labels) of the watershed of the outer region of a tile."""
+    index, outer, level = task
+    tile = np.array(_SHARED["stack"][outer]).view(Image3D)
+    tile = preprocess(tile)
+    labels = morphological_watershed(tile, level)
+    return index, np.asarray(labels, dtype=np.uint32)
+
+
+class UnionFind(object):
+    """Disjoint sets of provisional labels, from 1 upwards."""
+
+    def __init__(self):
+        self.parent = [0]
+
+    def add(self):
+        """Return a new label in a set of its own."""
+        self.parent.append(len(self.parent))
+        return len(self.parent) - 1
+
+    def find(self, label):
+        """Return the representative label of the set of label."""
+        root = label
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[label] != root:
+            self.parent[label], label = root, self.parent[label]
+        return root
+
+    def union(self, a, b):
+        """Merge the sets of labels a and b."""
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+    def lookup_table(self):
+        """Return array mapping every label to its set, numbered from 1."""
+        roots = np.array([self.find(label)
+                          for label in range(len(self.parent))],
+                         dtype=np.int64)
+        _, numbered = np.unique(roots, return_inverse=True)
+        # The background, label 0, is its own set and the smallest root.
+        return numbered.astype(np.uint32)
+
+
+def overlap_equivalences(tile_labels, global_labels, written):
+    """Return list of (tile_label, global_label) pairs of the same cell.
+
+    Only voxels marked as written are considered. A tile label and a global
+    label are the same cell if they share more than half of the voxels of
+    either of them in that region. A cell split into several global labels
+    by earlier tiles, or into several tile labels, is therefore joined,
+    while the slivers two neighbouring cells share where their walls differ
+    slightly between runs are not.
+    """
+    tile_values = tile_labels[written].astype(np.uint64)
+    global_values = global_labels[written].astype(np.uint64)
+    tile_ids, tile_counts = np.unique(tile_values, return_counts=True)
+    global_ids, global_counts = np.unique(global_values, return_counts=True)
+
+    keep = (tile_values != 0) & (global_values != 0)
+    pairs = (tile_values[keep] << np.uint64(32)) | global_values[keep]
+    pairs, counts = np.unique(pairs, return_counts=True)
+    tile_pair = pairs >> np.uint64(32)
+    global_pair = pairs & np.uint64(0xffffffff)
+    smaller = np.minimum(
+        tile_counts[np.searchsorted(tile_ids, tile_pair)],
+        global_counts[np.searchsorted(global_ids, global_pair)])
+    same = 2 * counts > smaller
+    return list(zip(tile_pair[same].tolist(), global_pair[same].tolist()))
+
+
+def stitch_tile(labels, written, tile_labels, outer, core, core_in_outer,
+                equivalences):
+    """Write the core of a tile into labels with provisional labels.
+
+    Every label of the tile gets a new provisional label, which is joined in
+    equivalences, a UnionFind, with the provisional labels of the same cell
+    already written by neighbouring tiles.
+    """
+    lut = np.zeros(int(tile_labels.max()) + 1, dtype=np.uint32)
+    tile_ids = np.unique(tile_labels)
+    for tile_id in tile_ids[tile_ids != 0]:
+        lut[tile_id] = equivalences.add()
+    for tile_id, global_id in overlap_equivalences(tile_labels, labels[outer],
+                                                   written[outer]):
+        equivalences.union(int(lut[tile_id]), global_id)
+
+    labels[core] = lut[tile_labels[core_in_outer]]
+    written[core] = True
+
+
+def label_agreement(reference, labels, min_jaccard=0.9):
+    """Return fraction of the cells of reference also found in labels.
+
+    A cell is found if a cell of labels overlaps it with a Jaccard index of
+    at least min_jaccard. Used to check blockwise segmentations against a
+    whole volume segmentation of the same stack.
+    """
+    reference = np.asarray(reference).astype(np.uint64).ravel()
+    labels = np.asarray(labels).astype(np.uint64).ravel()
+    ref_ids, ref_counts = np.unique(reference, return_counts=True)
+    ids, counts = np.unique(labels, return_counts=True)
+    keep = (reference != 0) & (labels != 0)
+    pairs = (reference[keep] << np.uint64(32)) | labels[keep]
+    pairs, overlaps = np.unique(pairs, return_counts=True)
+    ref_pair = pairs >> np.uint64(32)
+    pair = pairs & np.uint64(0xffffffff)
+    union = (ref_counts[np.searchsorted(ref_ids, ref_pair)] +
+             counts[np.searchsorted(ids, pair)] - overlaps)
+    found = np.unique(ref_pair[overlaps >= min_jaccard * union])
+    num_cells = np.count_nonzero(ref_ids)
+    return len(found) / float(num_cells) if num_cells else 1.0
+
+
+def watershed_blockwise(stack, level=0.664, tile_shape=DEFAULT_TILE_SHAPE,
+                        overlap=DEFAULT_OVERLAP, workers=None):
+    """Return stitched watershed labels of the preprocessed tiles of stack."""
+    overlap = max(overlap, FILTER_HALO)
+    shape = stack.shape
+    labels = np.zeros(shape, dtype=np.uint32)
+    written = np.zeros(shape, dtype=bool)
+    tile_list = tiles(shape, tile_shape, overlap)
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(tile_list))
+    itk_threads = max(1, multiprocessing.cpu_count() // workers)
+    pool = multiprocessing.Pool(processes=workers, initializer=_init_worker,
+                                initargs=(itk_threads, {"stack": stack}))
+    equivalences = UnionFind()
+    try:
+        tasks = [(i, outer, level)
+                 for i, (outer, _, _) in enumerate(tile_list)]
+        for i, tile_labels in pool.imap(_segment_tile, tasks):
+            outer, core, core_in_outer = tile_list[i]
+            stitch_tile(labels, written, tile_labels, outer, core,
+                        core_in_outer, equivalences)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Give every cell one identifier.
+    labels = equivalences.lookup_table()[labels]
+    return labels.view(ColorImage3D)
+
+
+def segment_blockwise(stack, level=0.664, tile_shape=DEFAULT_TILE_SHAPE,
+                      overlap=DEFAULT_OVERLAP, workers=None, hull="plane"):
+    """Segment the stack into 3D regions representing cells, tile by tile."""
+    mask = generate_mask(stack, hull)
+    with profile_stage("watershed_blockwise", stack):
+        labels = watershed_blockwise(stack, level, tile_shape, overlap,
+                                     workers)
+    return filter_segmented(labels, mask)
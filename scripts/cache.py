@@ -0,0 +1,152 @@
+"""Content addressed on-disk cache for intermediate images.
+
+Usage:
+
+    StageCache.directory = "/tmp/root-3d-cache"
+
+    @transformation
+    @cached(Image3D, helpers=(_median,))
+    def filter_median(im3d):
+        ...
+
+Results are keyed by a hash of the input arrays, the stage name, the stage
+parameters, the source code of the stage and of the helpers it calls, and
+StageCache.version, the version of the pipeline, and are stored as .npy files, which are memory mapped when
+read back. The least recently used entries are evicted once the total size
+of the cache exceeds StageCache.max_bytes. Caching is disabled while
+StageCache.directory is None.
+"""
+
+import os
+import inspect
+import hashlib
+import functools
+
+import numpy as np
+
+CACHE_EXT = ".npy"
+
+
+class StageCache(object):
+    """Cache configuration."""
+    directory = None
+    max_bytes = 10 * 2**30
+    version = None
+
+
+def _update_hash(sha1, value):
+    """Update sha1 with the content of value."""
+    if isinstance(value, np.ndarray):
+        array = np.ascontiguousarray(value)
+        sha1.update(str((array.shape, array.dtype.str)).encode("utf-8"))
+        sha1.update(array.ravel().view(np.uint8).data)
+    else:
+        sha1.update(repr(value).encode("utf-8"))
+
+
+def source_hash(*funcs):
+    """Return hex digest of the source code of functions."""
+    sha1 = hashlib.sha1()
+    for func in funcs:
+        try:
+            source = inspect.getsource(func)
+        except (IOError, TypeError):
+            source = ""
+        sha1.update(source.encode("utf-8"))
+    return sha1.hexdigest()
+
+
+def cache_key(name, args, kwargs, source=""):
+    """Return hex digest identifying a stage call.
+
+    Results cached by other versions of the pipeline or of the stage get
+    other keys, so that they are not returned after the code changed.
+    """
+    sha1 = hashlib.sha1()
+    sha1.update(name.encode("utf-8"))
+    sha1.update(repr(StageCache.version).encode("utf-8"))
+    sha1.update(source.encode("utf-8"))
+    for arg in args:
+        _update_hash(sha1, arg)
+    for key in sorted(kwargs):
+        sha1.update(key.encode("utf-8"))
+        _update_hash(sha1, kwargs[key])
+    return sha1.hexdigest()
+
+
+def _cache_entries(directory):
+    """Return list of (mtime, size, fpath) tuples, oldest first."""
+    entries = []
+    for fname in os.listdir(directory):
+        if not fname.endswith(CACHE_EXT):
+            continue
+        fpath = os.path.join(directory, fname)
+        try:
+            stat = os.stat(fpath)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, fpath))
+    return sorted(entries)
+
+
+def evict(directory, max_bytes):
+    """Remove least recently used entries until the cache fits max_bytes."""
+    entries = _cache_entries(directory)
+    total = sum(size for _, size, _ in entries)
+    for _, size, fpath in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(fpath)
+        except OSError:
+            continue
+        total -= size
+
+
+def load(key):
+    """Return cached array for key or None."""
+    fpath = os.path.join(StageCache.directory, key + CACHE_EXT)
+    if not os.path.isfile(fpath):
+        return None
+    # Record the use for the least recently used eviction.
+    os.utime(fpath, None)
+    # Copy on write so that in place operations downstream do not alter
+    # the cached entry.
+    return np.load(fpath, mmap_mode="c")
+
+
+def store(key, array):
+    """Atomically write array to the cache."""
+    directory = StageCache.directory
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fpath = os.path.join(directory, key + CACHE_EXT)
+    tmp_fpath = "{}.{}.tmp".format(fpath, os.getpid())
+    with open(tmp_fpath, "wb") as fh:
+        np.save(fh, np.asarray(array))
+    os.rename(tmp_fpath, fpath)
+    evict(directory, StageCache.max_bytes)
+
+
+def cached(cls, helpers=()):
+    """Return decorator caching the result of a stage as an instance of cls.
+
+    helpers are the functions the stage calls whose changes must invalidate
+    its cached results too.
+    """
+    def decorator(func):
+        source = source_hash(func, *helpers)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if StageCache.directory is None:
+                return func(*args, **kwargs)
+            key = cache_key(func.__name__, args, kwargs, source)
+            array = load(key)
+            if array is not None:
+                return array.view(cls)
+            result = func(*args, **kwargs)
+            store(key, result)
+            return result
+        return wrapper
+    return decorator
@@ -1,8 +1,10 @@
 """Script to concatenate all the csv output from top level analysis directory.
 
-Assumes analysis directory has the structure below:
-
-timepoint_directory/series_directory/cells.csv
+All cells.csv files below the analysis directory are concatenated, typically
+timepoint_directory/series_directory/cells.csv. Top level directories named
+after a .lif file are skipped, as they hold the same series in the layout of
+mass_process.py. See aggregate_cells.py for a typed dataset with genotype and
+treatment columns.
 """
 
 import argparse
@@ -10,6 +12,7 @@ import os
 import os.path
 
 from csv import header
+from aggregate_cells import series_directories
 
 
 def print_csv(directory):
@@ -20,21 +23,13 @@ def print_csv(directory):
 
 
 
-def process_timepoint_directory(directory):
-    series_paths = [os.path.join(directory, d)
-                    for d in os.listdir(directory)]
-    for s in series_paths:
-        print_csv(s)
-
-
 def process_top_directory(directory):
     print(header())
-    timepoints_paths = [os.path.join(directory, d)
-                        for d in os.listdir(directory)
-                        if not d.endswith(".lif")  \
-                        and not d.startswith(".")]
-    for t in timepoints_paths:
-        process_timepoint_directory(t)
+    for series_path in series_directories(directory):
+        top = os.path.relpath(series_path, directory).split(os.sep)[0]
+        if top.endswith(".lif"):
+            continue
+        print_csv(series_path)
 
 
 def main():
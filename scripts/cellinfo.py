@@ -1,35 +1,262 @@
 """Module for returning information about individual cells."""
 
 import numpy as np
+import scipy.ndimage
+
+from labels import label_index
+from measurements import (
+    DEFAULT_REDUCERS,
+    measurement_name,
+    measurement_names,
+)
+
+
+def _bounding_boxes(index, num_cells):
+    """Return (bbox_min, bbox_max) arrays of shape (num_cells, ndim).
+
+    The maximum is exclusive, i.e. the bounding box of cell i can be used as
+    slice(bbox_min[i, d], bbox_max[i, d]) along dimension d.
+    """
+    ndim = index.ndim
+    bbox_min = np.zeros((num_cells, ndim), dtype=np.intp)
+    bbox_max = np.zeros((num_cells, ndim), dtype=np.intp)
+    for i, slices in enumerate(scipy.ndimage.find_objects(index, num_cells)):
+        if slices is None:
+            continue
+        bbox_min[i] = [s.start for s in slices]
+        bbox_max[i] = [s.stop for s in slices]
+    return bbox_min, bbox_max
+
+
+def _sorted_by_label(values, index, num_cells):
+    """Return (sorted_values, starts, counts) of values grouped by label.
+
+    The values are sorted by label and, within a label, by value in a single
+    sort. Label 0, the background, comes first; starts and counts give the
+    segment of each label from 0 to num_cells in sorted_values.
+    """
+    flat_index = index.ravel()
+    flat_values = np.asarray(values).ravel()
+    if flat_values.dtype.kind in "bu" and flat_values.dtype.itemsize <= 2:
+        # Pack label and value into one integer key; sorting it is much
+        # faster than an indirect sort on two keys.
+        bits = 8 * flat_values.dtype.itemsize
+        key = (flat_index.astype(np.int64) << bits) | flat_values
+        key.sort()
+        sorted_values = (key & ((1 << bits) - 1)).astype(flat_values.dtype)
+    else:
+        order = np.lexsort((flat_values, flat_index))
+        sorted_values = flat_values[order]
+    counts = np.bincount(flat_index, minlength=num_cells + 1)
+    starts = np.zeros(num_cells + 1, dtype=np.intp)
+    starts[1:] = np.cumsum(counts)[:-1]
+    return sorted_values, starts, counts
+
+
+def _segment_sums(values, starts, counts):
+    """Return sum of values in each segment; empty segments sum to 0."""
+    sums = np.zeros(len(starts), dtype=np.float64)
+    nonempty = counts > 0
+    if nonempty.any():
+        # The non-empty segments tile the array, as reduceat requires.
+        sums[nonempty] = np.add.reduceat(values, starts[nonempty])
+    return sums
+
+
+def _segment_percentile(sorted_values, starts, counts, q):
+    """Return q-th percentile of each segment, interpolated linearly as in
+    np.percentile; nan for empty segments."""
+    position = (np.maximum(counts, 1) - 1) * (q / 100.0)
+    lower = np.floor(position).astype(np.intp)
+    upper = np.ceil(position).astype(np.intp)
+    last = max(len(sorted_values) - 1, 0)
+    lo_values = sorted_values[np.minimum(starts + lower, last)]
+    hi_values = sorted_values[np.minimum(starts + upper, last)]
+    lo_values = lo_values.astype(np.float64)
+    result = lo_values + (hi_values - lo_values) * (position - lower)
+    result[counts == 0] = np.nan
+    return result
+
+
+# Reducers that sum the voxel values and need them as float64.
+_SUM_REDUCERS = ("total", "mean", "std")
+
+
+def _base_reducer(reducer):
+    """Return reducer without its "_bgsub" suffix."""
+    if reducer.endswith("_bgsub"):
+        return reducer[:-len("_bgsub")]
+    return reducer
+
+
+def _reduce(reducer, sorted_values, starts, counts, background,
+            float_values=None):
+    """Return values of a reducer for every segment.
+
+    Reducers are "total", "mean", "std", "min", "max", "median" and "p<q>"
+    for the q-th percentile. Any reducer but "std" can take a "_bgsub"
+    suffix to subtract the background, the median of the label 0 voxels.
+    The sum based reducers use float_values, sorted_values as float64,
+    which is converted here if not given.
+    """
+    if reducer.endswith("_bgsub"):
+        base = _base_reducer(reducer)
+        if base == "std":
+            raise ValueError("Unknown reducer: {}".format(reducer))
+        values = _reduce(base, sorted_values, starts, counts, background,
+                         float_values)
+        if base == "total":
+            return values - background * counts
+        return values - background
+
+    if reducer in _SUM_REDUCERS and float_values is None:
+        float_values = sorted_values.astype(np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if reducer == "total":
+            return _segment_sums(float_values, starts, counts)
+        if reducer == "mean":
+            return _segment_sums(float_values, starts, counts) / counts
+        if reducer == "std":
+            mean = _segment_sums(float_values, starts, counts) / counts
+            mean_sq = _segment_sums(float_values * float_values, starts,
+                                    counts) / counts
+            return np.sqrt(np.maximum(mean_sq - mean * mean, 0))
+    if reducer == "min":
+        return _segment_percentile(sorted_values, starts, counts, 0)
+    if reducer == "max":
+        return _segment_percentile(sorted_values, starts, counts, 100)
+    if reducer == "median":
+        return _segment_percentile(sorted_values, starts, counts, 50)
+    if reducer.startswith("p"):
+        try:
+            q = float(reducer[1:])
+        except ValueError:
+            q = None
+        if q is not None and 0 <= q <= 100:
+            return _segment_percentile(sorted_values, starts, counts, q)
+    raise ValueError("Unknown reducer: {}".format(reducer))
+
+
+def measure(sorted_values, starts, counts, channel, reducers):
+    """Return dictionary of the measurements of the cells of one channel."""
+    background = 0.0
+    if counts[0] > 0:
+        background = _segment_percentile(sorted_values, starts, counts, 50)[0]
+    # Convert the values once for all the sum based reducers; the order
+    # statistics index sorted_values directly.
+    float_values = None
+    if any(_base_reducer(r) in _SUM_REDUCERS for r in reducers):
+        float_values = sorted_values.astype(np.float64)
+    return dict((measurement_name(channel, r),
+                 _reduce(r, sorted_values, starts, counts, background,
+                         float_values)[1:])
+                for r in reducers)
+
+
+def cell_table(intensity_stack, segmentation, channels=None,
+               reducers=DEFAULT_REDUCERS):
+    """Return columnar table of per cell statistics.
+
+    All statistics are computed for every label at once using bincount style
+    reductions and a single sort per channel over the label volume, rather
+    than by extracting each region in turn. The table is a dictionary of
+    numpy arrays with one entry per cell, ordered by cell identifier:
+
+    - cell_id: identifier of the cell in the segmentation
+    - voxels: number of voxels in the cell
+    - total_intensity: summed voxel intensity
+    - centroid: (num_cells, ndim) array of centroid coordinates
+    - bbox_min, bbox_max: (num_cells, ndim) bounding box, max exclusive
+    - min_intensity, max_intensity, std_intensity: voxel intensity spread
+
+    If channels, a dictionary mapping channel identifiers to stacks, is
+    given, every reducer is also applied to every channel, see
+    measurements.py.
+    """
+    intensities = np.asarray(intensity_stack)
+    identifiers, index = label_index(segmentation)
+    num_cells = len(identifiers)
+    flat_index = index.ravel()
+    flat_intensities = intensities.ravel().astype(np.float64)
+
+    def per_label_sum(weights=None):
+        return np.bincount(flat_index, weights=weights,
+                           minlength=num_cells + 1)[1:]
+
+    voxels = per_label_sum().astype(np.int64)
+    total = per_label_sum(flat_intensities)
+    total_sq = per_label_sum(flat_intensities * flat_intensities)
+    del flat_intensities
+
+    centroid = np.zeros((num_cells, index.ndim), dtype=np.float64)
+    for dim, size in enumerate(index.shape):
+        shape = [1] * index.ndim
+        shape[dim] = size
+        coords = np.arange(size, dtype=np.float64).reshape(shape)
+        coords = np.broadcast_to(coords, index.shape).ravel()
+        centroid[:, dim] = per_label_sum(coords) / voxels
+
+    mean = total / voxels
+    variance = np.maximum(total_sq / voxels - mean * mean, 0)
+
+    bbox_min, bbox_max = _bounding_boxes(index, num_cells)
+
+    table = {"cell_id": identifiers,
+             "voxels": voxels,
+             "total_intensity": total,
+             "centroid": centroid,
+             "bbox_min": bbox_min,
+             "bbox_max": bbox_max,
+             "std_intensity": np.sqrt(variance)}
+
+    # The sorted pass over the intensity stack gives its minimum and
+    # maximum and is reused if it is also one of the measured channels.
+    intensity_pass = _sorted_by_label(intensities, index, num_cells)
+    sorted_values, starts, counts = intensity_pass
+    table["min_intensity"] = sorted_values[starts[1:]]
+    table["max_intensity"] = sorted_values[starts[1:] + counts[1:] - 1]
+
+    for channel, stack in sorted((channels or {}).items()):
+        if stack is intensity_stack:
+            sorted_values, starts, counts = intensity_pass
+        else:
+            sorted_values, starts, counts = _sorted_by_label(stack, index,
+                                                             num_cells)
+        table.update(measure(sorted_values, starts, counts, channel,
+                             reducers))
+    return table
 
 
 def find_summed_intensity_per_cell(intensity_stack, segmentation):
     """Return dictionary in which keys are region identifiers and values are
     summed voxel intensities taken from intensity_stack."""
 
+    table = cell_table(intensity_stack, segmentation)
     summed_intensities = {}
-
-    for i in segmentation.identifiers:
-        region_coords = segmentation.region_by_identifier(i).index_arrays
-        value = int(np.sum(intensity_stack[region_coords]))
-        summed_intensities[str(i)] = dict(total_intensity=value)
+    for i, value in zip(table["cell_id"], table["total_intensity"]):
+        summed_intensities[str(i)] = dict(total_intensity=int(value))
 
     return summed_intensities
 
 
-def cellinfo(intensity_stack, segmented_stack):
-    """Return list of dictionaries with cell information."""
-    summary_data = find_summed_intensity_per_cell(intensity_stack,
-                                                  segmented_stack)
+def cellinfo(intensity_stack, segmented_stack, channels=None,
+             reducers=DEFAULT_REDUCERS):
+    """Return list of dictionaries with cell information.
 
-    for identifier in segmented_stack.identifiers:
-        segment = segmented_stack.region_by_identifier(identifier)
-        voxels = int(segment.area)
-        centroid = map(float, segment.centroid)
+    If channels, a dictionary mapping channel identifiers to stacks, is
+    given the measurements of every reducer on every channel are included.
+    """
+    table = cell_table(intensity_stack, segmented_stack, channels, reducers)
+    names = measurement_names(sorted(channels or {}), reducers)
 
-        datum = {"voxels": voxels,
-                 "centroid": centroid,
-                 "cell_id": int(identifier)}
-        summary_data[str(identifier)].update(datum)
+    summary_data = []
+    for i in range(len(table["cell_id"])):
+        datum = {"total_intensity": int(table["total_intensity"][i]),
+                 "voxels": int(table["voxels"][i]),
+                 "centroid": [float(c) for c in table["centroid"][i]],
+                 "cell_id": int(table["cell_id"][i])}
+        for name in names:
+            datum[name] = float(table[name][i])
+        summary_data.append(datum)
 
-    return summary_data.values()
+    return summary_data
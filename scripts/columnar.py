@@ -0,0 +1,140 @@
+"""Typed columnar tables of the cell measurements of a series.
+
+A table is a dictionary mapping the names in csv.COLUMNS to NumPy arrays.
+Tables are written next to cells.csv as Parquet if pyarrow is available and
+as NumPy .npz archives otherwise. Both keep the column types, so that the
+tables of many series can be aggregated without parsing text.
+"""
+
+import io
+import os
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+from csv import COLUMNS, COLUMN_TYPES, cell_values
+
+CELLS_CSV_FNAME = "cells.csv"
+CELLS_PARQUET_FNAME = "cells.parquet"
+CELLS_NPZ_FNAME = "cells.npz"
+
+NUMPY_TYPES = {str: np.str_, int: np.int64, float: np.float64}
+
+
+def have_pyarrow():
+    """Return True if pyarrow is available."""
+    try:
+        import pyarrow  # NOQA
+        import pyarrow.parquet  # NOQA
+    except ImportError:
+        return False
+    return True
+
+
+def typed_column(values, column_type):
+    """Return NumPy array of values of a str, int or float column."""
+    return np.array([column_type(v) for v in values],
+                    dtype=NUMPY_TYPES[column_type])
+
+
+def cells_table(fname, series_name, series_id, cellinfo):
+    """Return table of the cells of a series."""
+    rows = [cell_values(fname, series_name, series_id, cell)
+            for cell in cellinfo]
+    table = OrderedDict()
+    for name in COLUMNS:
+        # Measurements missing from the cellinfo are stored as nan.
+        table[name] = typed_column([r.get(name, np.nan) for r in rows],
+                                   COLUMN_TYPES[name])
+    return table
+
+
+def arrow_table(table):
+    """Return pyarrow Table of a table."""
+    import pyarrow as pa
+    arrays = []
+    for name, column in table.items():
+        if column.dtype.kind in "SU":
+            arrays.append(pa.array(column.tolist(), type=pa.string()))
+        else:
+            arrays.append(pa.array(column))
+    return pa.Table.from_arrays(arrays, names=list(table.keys()))
+
+
+def write_npz(fh, table):
+    """Write table to an open file as an uncompressed .npz archive.
+
+    np.savez cannot be used since it takes the file as a keyword argument,
+    which clashes with the file column.
+    """
+    with zipfile.ZipFile(fh, mode="w", compression=zipfile.ZIP_STORED,
+                         allowZip64=True) as archive:
+        for name, column in table.items():
+            buf = io.BytesIO()
+            np.lib.format.write_array(buf, np.asanyarray(column),
+                                      allow_pickle=False)
+            archive.writestr(name + ".npy", buf.getvalue())
+
+
+def write_cells_table(table, output_directory):
+    """Write table to the output directory; return the path of the file."""
+    if have_pyarrow():
+        import pyarrow.parquet as pq
+        fpath = os.path.join(output_directory, CELLS_PARQUET_FNAME)
+        tmp_fpath = "{}.{}.tmp".format(fpath, os.getpid())
+        pq.write_table(arrow_table(table), tmp_fpath)
+    else:
+        fpath = os.path.join(output_directory, CELLS_NPZ_FNAME)
+        tmp_fpath = "{}.{}.tmp".format(fpath, os.getpid())
+        with open(tmp_fpath, "wb") as fh:
+            write_npz(fh, table)
+    os.rename(tmp_fpath, fpath)
+    return fpath
+
+
+def find_cells_table(directory):
+    """Return path of the most complete cells table in directory or None."""
+    for fname in (CELLS_PARQUET_FNAME, CELLS_NPZ_FNAME, CELLS_CSV_FNAME):
+        fpath = os.path.join(directory, fname)
+        if os.path.isfile(fpath):
+            if fname == CELLS_PARQUET_FNAME and not have_pyarrow():
+                continue
+            return fpath
+    return None
+
+
+def read_csv_table(fpath):
+    """Return table parsed from a headerless cells.csv file.
+
+    The values are assumed to be in the order of csv.COLUMNS; files written
+    before columns were added only hold the leading columns.
+    """
+    with open(fpath) as fh:
+        rows = [line.rstrip("\n").split(",") for line in fh if line.strip()]
+    names = COLUMNS[:len(rows[0])] if rows else COLUMNS
+    table = OrderedDict()
+    for i, name in enumerate(names):
+        column_type = COLUMN_TYPES[name]
+        values = [r[i] for r in rows]
+        if column_type is float:
+            values = [v if v else np.nan for v in values]
+        table[name] = typed_column(values, column_type)
+    return table
+
+
+def read_cells_table(fpath):
+    """Return table read from a Parquet, .npz or CSV file."""
+    if fpath.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        arrow = pq.read_table(fpath)
+        table = OrderedDict()
+        for name in arrow.column_names:
+            values = arrow.column(name).to_pylist()
+            table[name] = typed_column(values, COLUMN_TYPES.get(name, float))
+        return table
+    if fpath.endswith(".npz"):
+        with np.load(fpath) as npz:
+            return OrderedDict((name, npz[name]) for name in COLUMNS
+                               if name in npz.files)
+    return read_csv_table(fpath)
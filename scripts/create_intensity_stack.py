@@ -1,16 +1,14 @@
 """Create stack where each cell is coloured by normalised intensity."""
 
 import argparse
-import json
 
 import numpy as np
 
 import os
 import os.path
 
-from jicbioimage.illustrate import Canvas
-
-from utils import ColorImage3D
+from utils import load_istack
+from stackwriter import write_zslices
 
 
 def mean_intensity(cell_props):
@@ -23,81 +21,90 @@ def total_intensity(cell_props):
     return float(cell_props["total_intensity"])
 
 
-def min_max_cell_intensity(cellinfo, intensity_method):
-    """Return (min, max) cell intensity tuple."""
-    cell_intensities = [intensity_method(p) for p in cellinfo]
-    return min(cell_intensities), max(cell_intensities)
-
-
-def get_normalised_rgb_from_cell_intensity(cell_intensity, imin, imax):
-    green = ((cell_intensity - imin) / (imax - imin)) * 255
-    green = int(round(green))
-    assert green >= 0
-    assert green < 256
-    return (green, green, 255 - green)
+def color_lookup_table(cellinfo, intensity_method, max_label):
+    """Return (max_label + 1, 3) uint8 array mapping cell id to colour.
+
+    Labels that are not in cellinfo, including background, map to black.
+    """
+    lut = np.zeros((max_label + 1, 3), dtype=np.uint8)
+    if len(cellinfo) == 0:
+        return lut
+    cell_ids = np.array([p["cell_id"] for p in cellinfo], dtype=np.intp)
+    intensities = np.array([intensity_method(p) for p in cellinfo],
+                           dtype=np.float64)
+    imin, imax = intensities.min(), intensities.max()
+    span = (imax - imin) if imax > imin else 1.0
+    green = np.floor((intensities - imin) / span * 255 + 0.5)
+    green = green.astype(np.uint8)
+    in_range = cell_ids <= max_label
+    lut[cell_ids[in_range], 0] = green[in_range]
+    lut[cell_ids[in_range], 1] = green[in_range]
+    lut[cell_ids[in_range], 2] = 255 - green[in_range]
+    return lut
+
+
+def create_intensity_stacks(cells, cellinfo, stacks):
+    """Write zslices for several intensity methods in one pass.
+
+    stacks is a list of (intensity_method, output_dir) tuples. A colour
+    lookup table is built once per intensity method and the lookup tables
+    are concatenated so that every z-slice of the label volume is only
+    indexed once for all the stacks. The z-slices are encoded and written
+    by the stack writer; returns its per-slice timings.
+    """
+    for _, output_dir in stacks:
+        if not os.path.isdir(output_dir):
+            os.mkdir(output_dir)
+
+    max_label = int(cells.max()) if cells.size else 0
+    lut = np.hstack([color_lookup_table(cellinfo, method, max_label)
+                     for method, _ in stacks])
+
+    def render(zi):
+        rgbs = lut[np.asarray(cells[:, :, zi])]
+        return [(os.path.join(output_dir, "z{:02d}".format(zi)),
+                 rgbs[:, :, 3*i:3*i+3])
+                for i, (_, output_dir) in enumerate(stacks)]
 
+    ydim, xdim, zdim = cells.shape
+    return write_zslices(zdim, render)
 
-def write_zslice(zslice, cellinfo, fpath, intensity_method):
-    """Write PNG z-slice."""
-    ydim, xdim = zslice.shape
-    imin, imax = min_max_cell_intensity(cellinfo, intensity_method)
-    canvas = Canvas.blank_canvas(width=xdim, height=ydim)
-    for i, props in enumerate(cellinfo):
-        cell_intenistity = intensity_method(props)
-        color = get_normalised_rgb_from_cell_intensity(cell_intenistity,
-                                                       imin, imax)
-        region = zslice == props["cell_id"]
-        if np.sum(region) == 0:
-            continue
-        canvas.mask_region(region, color)
 
-    with open(fpath, "wb") as fh:
-        fh.write(canvas.png())
+def create_mean_and_total_intensity_stacks(cells, cellinfo, mean_output_dir,
+                                           total_output_dir):
+    """Write mean and total intensity zslices to stack directories."""
+    return create_intensity_stacks(cells, cellinfo,
+                                   [(mean_intensity, mean_output_dir),
+                                    (total_intensity, total_output_dir)])
 
 
 def create_mean_intensity_stack(cells, cellinfo, output_dir):
-    """Write PNG zslices to stack directory."""
-    if not os.path.isdir(output_dir):
-        os.mkdir(output_dir)
-
-    ydim, xdim, zdim = cells.shape
-    for zi in range(zdim):
-        write_zslice(cells[:, :, zi],
-                     cellinfo,
-                     os.path.join(output_dir, "z{:02d}.png".format(zi)),
-                     mean_intensity)
+    """Write zslices to stack directory."""
+    return create_intensity_stacks(cells, cellinfo,
+                                   [(mean_intensity, output_dir)])
 
 
 def create_total_intensity_stack(cells, cellinfo, output_dir):
-    """Write PNG zslices to stack directory."""
-    if not os.path.isdir(output_dir):
-        os.mkdir(output_dir)
-
-    ydim, xdim, zdim = cells.shape
-    for zi in range(zdim):
-        write_zslice(cells[:, :, zi],
-                     cellinfo,
-                     os.path.join(output_dir, "z{:02d}.png".format(zi)),
-                     total_intensity)
-
+    """Write zslices to stack directory."""
+    return create_intensity_stacks(cells, cellinfo,
+                                   [(total_intensity, output_dir)])
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("input_dir")
+    parser.add_argument("input_dir", help="istack directory or label volume")
     parser.add_argument("output_dir")
     args = parser.parse_args()
 
-    if not os.path.isdir(args.input_dir):
-        parser.error("No such dir: " + args.input_dir)
+    if not os.path.exists(args.input_dir):
+        parser.error("No such dir or file: " + args.input_dir)
 
-    cellinfo = json.load(file(os.path.join(args.input_dir, "cellinfo.json")))
-    cells = ColorImage3D.from_directory(args.input_dir)
+    cells, cellinfo = load_istack(args.input_dir)
 
     if not os.path.isdir(args.output_dir):
         os.mkdir(args.output_dir)
 
-    create_mean_intensity_stack(cells, cellinfo,
-                           os.path.join(args.output_dir, "mean_intensity"))
-    create_total_intensity_stack(cells, cellinfo,
-                                 os.path.join(args.output_dir, "total_intensity"))
+    create_mean_and_total_intensity_stacks(
+        cells, cellinfo,
+        os.path.join(args.output_dir, "mean_intensity"),
+        os.path.join(args.output_dir, "total_intensity"))
@@ -4,6 +4,16 @@ import os.path
 import argparse
 import json
 
+from measurements import (
+    DEFAULT_CHANNELS,
+    DEFAULT_REDUCERS,
+    NEIGHBOUR_COLUMNS,
+    measurement_names,
+)
+
+MEASUREMENT_COLUMNS = tuple(measurement_names(DEFAULT_CHANNELS,
+                                              DEFAULT_REDUCERS))
+
 COLUMNS = ("file",
            "series_name",
            "series_id",
@@ -12,27 +22,48 @@ COLUMNS = ("file",
            "total_intensity",
            "x",
            "y",
-           "z")
+           "z") + MEASUREMENT_COLUMNS + NEIGHBOUR_COLUMNS
+
+COLUMN_TYPES = {"file": str,
+                "series_name": str,
+                "series_id": int,
+                "cell_id": int,
+                "voxels": int,
+                "total_intensity": float,
+                "x": float,
+                "y": float,
+                "z": float}
+COLUMN_TYPES.update((name, float) for name in MEASUREMENT_COLUMNS)
+# The neighbour counts are floats too, so that missing values can be nan.
+COLUMN_TYPES.update((name, float) for name in NEIGHBOUR_COLUMNS)
 
 
 def header():
     return ",".join(COLUMNS)
 
 
-def row(fname, series_name, series_id, cell):
-    cell["file"] = fname
-    cell["series_name"] = series_name
-    cell["series_id"] = series_id
+def cell_values(fname, series_name, series_id, cell):
+    """Return dictionary of the column values of a cell.
+
+    The cell dictionary is not modified.
+    """
+    values = dict(cell)
+    values["file"] = fname
+    values["series_name"] = series_name
+    values["series_id"] = series_id
 
     # Split centroid into x, y, z.
-    y, x, z = cell["centroid"]
-    del cell["centroid"]
-    cell["x"] = x
-    cell["y"] = y
-    cell["z"] = z
-
-    values = [str(cell[k]) for k in COLUMNS]
-    return ','.join(values)
+    y, x, z = values.pop("centroid")
+    values["x"] = x
+    values["y"] = y
+    values["z"] = z
+    return values
+
+
+def row(fname, series_name, series_id, cell):
+    """Return CSV line of a cell; measurements it lacks are left empty."""
+    values = cell_values(fname, series_name, series_id, cell)
+    return ','.join([str(values.get(k, "")) for k in COLUMNS])
 
 
 def csv(fname, series_name, series_id, cellinfo):
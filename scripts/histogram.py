@@ -1,13 +1,38 @@
-"""Thin wrapper to call R."""
+"""Generate mean and total intensity histograms.
+
+The histograms are rendered in-process with matplotlib if it is available.
+Otherwise the R script histogram.R is called as a fallback.
+
+In batch mode the histograms of all series in an analysis directory are
+rendered from a single process.
+"""
 
 import os
+import json
+import logging
 import argparse
 
 HERE = os.path.dirname(os.path.realpath(__file__))
 RSCRIPT = os.path.join(HERE, "histogram.R")
 
+MEAN_HISTOGRAM_FNAME = "mean_intensity_histogram.png"
+SUM_HISTOGRAM_FNAME = "sum_intensity_histogram.png"
+
+# Number of bins used by default by ggplot2's geom_histogram.
+NUM_BINS = 30
+
+
+def have_matplotlib():
+    """Return True if matplotlib is available."""
+    try:
+        import matplotlib  # NOQA
+    except ImportError:
+        return False
+    return True
 
-def generate_histogram(cellinfo_fpath, mean_output_fpath, sum_output_fpath):
+
+def generate_histogram_r(cellinfo_fpath, mean_output_fpath, sum_output_fpath):
+    """Generate histograms using R; return the exit status of Rscript."""
     cmd = "Rscript {} {} {} {}".format(RSCRIPT,
                                        cellinfo_fpath,
                                        mean_output_fpath,
@@ -15,10 +40,108 @@ def generate_histogram(cellinfo_fpath, mean_output_fpath, sum_output_fpath):
     return os.system(cmd)
 
 
+def plot_histogram(values, xlabel, output_fpath):
+    """Write histogram of values coloured from blue to yellow."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import LinearSegmentedColormap
+
+    cmap = LinearSegmentedColormap.from_list("blue_yellow",
+                                             ["blue", "yellow"])
+    fig, ax = plt.subplots()
+    try:
+        counts, edges, patches = ax.hist(values, bins=NUM_BINS)
+        if len(values):
+            lo, hi = edges[0], edges[-1]
+            span = (hi - lo) or 1.0
+            for left, right, patch in zip(edges[:-1], edges[1:], patches):
+                patch.set_facecolor(cmap(((left + right) / 2 - lo) / span))
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel("count")
+        fig.savefig(output_fpath)
+    finally:
+        plt.close(fig)
+
+
+def plot_histograms(cellinfo, mean_output_fpath, sum_output_fpath):
+    """Write mean and total intensity histograms from in-memory cellinfo."""
+    totals = [float(p["total_intensity"]) for p in cellinfo]
+    means = [t / p["voxels"] for t, p in zip(totals, cellinfo)]
+    plot_histogram(means, "mean.intensity", mean_output_fpath)
+    plot_histogram(totals, "total_intensity", sum_output_fpath)
+
+
+def generate_histogram(cellinfo_fpath, mean_output_fpath, sum_output_fpath,
+                       cellinfo=None):
+    """Generate histograms; return 0 on success.
+
+    If given, the in-memory cellinfo is used rather than re-reading
+    cellinfo_fpath. Falls back to R if matplotlib is not available.
+    """
+    if not have_matplotlib():
+        logging.warning("matplotlib is not installed, using R for histograms")
+        return generate_histogram_r(cellinfo_fpath,
+                                    mean_output_fpath,
+                                    sum_output_fpath)
+    if cellinfo is None:
+        with open(cellinfo_fpath) as fh:
+            cellinfo = json.load(fh)
+    plot_histograms(cellinfo, mean_output_fpath, sum_output_fpath)
+    return 0
+
+
+def filtered_cellinfo_fpath(series_directory):
+    """Return path to filtered cellinfo JSON file in directory or None."""
+    for fpath in [os.path.join(series_directory, "filtered.istack",
+                               "cellinfo.json"),
+                  os.path.join(series_directory, "filtered_cellinfo.json")]:
+        if os.path.isfile(fpath):
+            return fpath
+    return None
+
+
+def generate_all_histograms(directory):
+    """Generate histograms for every analysed series below directory.
+
+    Returns number of series for which histograms were generated.
+    """
+    count = 0
+    for dirpath, dirnames, fnames in os.walk(directory):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")
+                       and not d.endswith(".istack")
+                       and not d.endswith(".stack")]
+        cellinfo_fpath = filtered_cellinfo_fpath(dirpath)
+        if cellinfo_fpath is None:
+            continue
+        return_code = generate_histogram(
+            cellinfo_fpath,
+            os.path.join(dirpath, MEAN_HISTOGRAM_FNAME),
+            os.path.join(dirpath, SUM_HISTOGRAM_FNAME))
+        if int(return_code) == 0:
+            count += 1
+        else:
+            logging.warning("Failed to generate histogram: {}".format(dirpath))
+    return count
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("input_fpath")
-    parser.add_argument("output_fpath")
+    parser.add_argument("input_fpath",
+                        help="cellinfo JSON file or, with --batch, analysis directory")
+    parser.add_argument("mean_output_fpath", nargs="?")
+    parser.add_argument("sum_output_fpath", nargs="?")
+    parser.add_argument("--batch", default=False, action="store_true",
+                        help="Generate histograms for all series in directory")
     args = parser.parse_args()
 
-    generate_histogram(args.input_fpath, args.output_fpath)
+    if args.batch:
+        if not os.path.isdir(args.input_fpath):
+            parser.error("Not a directory: " + args.input_fpath)
+        generate_all_histograms(args.input_fpath)
+    else:
+        if args.mean_output_fpath is None or args.sum_output_fpath is None:
+            parser.error("Output file paths are required")
+        generate_histogram(args.input_fpath,
+                           args.mean_output_fpath,
+                           args.sum_output_fpath)
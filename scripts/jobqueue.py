@@ -0,0 +1,282 @@
+"""SQLite backed queue of series analysis jobs.
+
+Jobs are (file, series, parameters) tuples stored in a SQLite database in the
+output directory. Worker processes, on one host or on several hosts sharing
+the file system, claim jobs from the queue. A claimed job is leased to its
+worker for a limited time and the worker extends the lease with heartbeats
+while it runs. Jobs whose lease has expired, because their worker died, are
+returned to the queue. Jobs with a higher priority are claimed first.
+
+SQLite relies on file locking, which must work on the shared file system for
+several hosts to use the same queue.
+
+The progress of the jobs can be inspected while they run:
+
+    $ python scripts/jobqueue.py status output_dir
+"""
+
+import os
+import json
+import time
+import datetime
+import sqlite3
+import argparse
+import contextlib
+
+JOB_QUEUE_FNAME = "jobs.sqlite"
+
+LEASE_SECONDS = 300
+MAX_ATTEMPTS = 2
+THROUGHPUT_WINDOW = 3600
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+STATUSES = (PENDING, RUNNING, DONE, FAILED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    fpath TEXT NOT NULL,
+    series INTEGER NOT NULL,
+    output_path TEXT NOT NULL,
+    backend_dir TEXT NOT NULL,
+    parameters TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    started REAL,
+    finished REAL,
+    error TEXT,
+    UNIQUE (fpath, series)
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority, id);
+"""
+
+
+def job_queue_fpath(output_directory):
+    """Return path of the job queue database of an output directory."""
+    return os.path.join(output_directory, JOB_QUEUE_FNAME)
+
+
+class JobQueue(object):
+    """Queue of analysis jobs stored in a SQLite database."""
+
+    def __init__(self, fpath, lease_seconds=LEASE_SECONDS,
+                 max_attempts=MAX_ATTEMPTS):
+        self.fpath = fpath
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._connection = sqlite3.connect(fpath, timeout=60,
+                                           isolation_level=None)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.executescript(_SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Context manager holding the database write lock."""
+        cursor = self._connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+
+    def add(self, jobs, backend_dir, parameters=None, priority=0):
+        """Add (fpath, series, output_path) jobs; return number queued.
+
+        Jobs already in the queue that are not running, including done and
+        failed ones, are returned to the queue with the new parameters, so
+        that resubmitting after a change of parameters or version reruns
+        them. Running jobs are left as is.
+        """
+        parameters = json.dumps(parameters, sort_keys=True)
+        with self._transaction() as cursor:
+            queued = 0
+            for fpath, series, output_path in jobs:
+                # Insert then update, rather than an upsert, which needs
+                # SQLite 3.24.
+                cursor.execute(
+                    "INSERT OR IGNORE INTO jobs "
+                    "(fpath, series, output_path, backend_dir, parameters, "
+                    "priority) VALUES (?, ?, ?, ?, ?, ?)",
+                    (fpath, series, output_path, backend_dir, parameters,
+                     priority))
+                if cursor.rowcount == 0:
+                    cursor.execute(
+                        "UPDATE jobs SET output_path = ?, backend_dir = ?, "
+                        "parameters = ?, priority = ?, status = ?, "
+                        "attempts = 0, worker = NULL, lease_expires = NULL, "
+                        "error = NULL "
+                        "WHERE fpath = ? AND series = ? AND status != ?",
+                        (output_path, backend_dir, parameters, priority,
+                         PENDING, fpath, series, RUNNING))
+                queued += cursor.rowcount
+        return queued
+
+    def _expire_leases(self, cursor, now):
+        """Return jobs of dead workers to the queue or mark them failed."""
+        cursor.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, "
+            "worker = NULL, lease_expires = NULL, "
+            "error = 'Lease expired on worker ' || worker "
+            "WHERE status = ? AND lease_expires < ?",
+            (self.max_attempts, PENDING, FAILED, RUNNING, now))
+
+    def claim(self, worker):
+        """Lease the pending job with the highest priority to a worker.
+
+        Returns dictionary describing the job or None if no job is pending.
+        """
+        now = time.time()
+        with self._transaction() as cursor:
+            self._expire_leases(cursor, now)
+            cursor.execute(
+                "SELECT * FROM jobs WHERE status = ? "
+                "ORDER BY priority DESC, id LIMIT 1", (PENDING,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            cursor.execute(
+                "UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, "
+                "started = ?, attempts = attempts + 1 WHERE id = ?",
+                (RUNNING, worker, now + self.lease_seconds, now, row["id"]))
+        job = dict(row)
+        job.update(status=RUNNING, worker=worker, started=now,
+                   attempts=row["attempts"] + 1)
+        job["parameters"] = json.loads(job["parameters"])
+        return job
+
+    def heartbeat(self, job_id, worker):
+        """Extend the lease of a job; return False if the job was lost."""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET lease_expires = ? "
+                "WHERE id = ? AND worker = ? AND status = ?",
+                (time.time() + self.lease_seconds, job_id, worker, RUNNING))
+            return cursor.rowcount == 1
+
+    def complete(self, job_id, worker):
+        """Mark a job as done."""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET status = ?, finished = ?, lease_expires = NULL, "
+                "error = NULL WHERE id = ? AND worker = ?",
+                (DONE, time.time(), job_id, worker))
+
+    def fail(self, job_id, worker, error):
+        """Return a failed job to the queue, or mark it failed if it has
+        been attempted max_attempts times."""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts < ? THEN ? ELSE ? END, "
+                "finished = ?, lease_expires = NULL, error = ? "
+                "WHERE id = ? AND worker = ?",
+                (self.max_attempts, PENDING, FAILED, time.time(), error,
+                 job_id, worker))
+
+    def requeue_failed(self):
+        """Return all failed jobs to the queue; return their number."""
+        with self._transaction() as cursor:
+            cursor.execute(
+                "UPDATE jobs SET status = ?, attempts = 0 WHERE status = ?",
+                (PENDING, FAILED))
+            return cursor.rowcount
+
+    def unfinished(self):
+        """Return number of jobs that are pending or running."""
+        cursor = self._connection.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)",
+            (PENDING, RUNNING))
+        return cursor.fetchone()[0]
+
+    def failures(self):
+        """Return list of dictionaries describing the failed jobs."""
+        cursor = self._connection.execute(
+            "SELECT fpath, series, output_path, attempts, error FROM jobs "
+            "WHERE status = ? ORDER BY id", (FAILED,))
+        return [dict(row) for row in cursor]
+
+    def status(self, window=THROUGHPUT_WINDOW):
+        """Return dictionary with the job counts, throughput and ETA.
+
+        The throughput, in jobs per hour, is measured over the jobs finished
+        in the last window seconds. The ETA is in seconds and None if no job
+        has finished in that time.
+        """
+        now = time.time()
+        counts = dict((status, 0) for status in STATUSES)
+        for row in self._connection.execute(
+                "SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+            counts[row[0]] = row[1]
+        recent = self._connection.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = ? AND finished > ?",
+            (DONE, now - window)).fetchone()[0]
+        throughput = None
+        eta = None
+        if recent:
+            # Measure from the first job started in the window when the
+            # queue has not been running for the whole window.
+            start = self._connection.execute(
+                "SELECT MIN(started) FROM jobs WHERE finished > ?",
+                (now - window,)).fetchone()[0]
+            elapsed = max(now - max(start, now - window), 1.0)
+            throughput = recent / elapsed * 3600
+            eta = (counts[PENDING] + counts[RUNNING]) / throughput * 3600
+        workers = self._connection.execute(
+            "SELECT COUNT(DISTINCT worker) FROM jobs WHERE status = ?",
+            (RUNNING,)).fetchone()[0]
+        return {"counts": counts,
+                "workers": workers,
+                "jobs_per_hour": throughput,
+                "eta_seconds": eta}
+
+
+def format_status(status):
+    """Return human readable summary of a queue status."""
+    counts = status["counts"]
+    lines = ["{:<8} {:>8}".format(s, counts[s]) for s in STATUSES]
+    lines.append("{:<8} {:>8}".format("workers", status["workers"]))
+    if status["jobs_per_hour"] is None:
+        lines.append("No jobs finished in the last hour")
+    else:
+        lines.append("Throughput: {:.1f} jobs/hour".format(
+            status["jobs_per_hour"]))
+        lines.append("ETA: {}".format(
+            datetime.timedelta(seconds=int(status["eta_seconds"]))))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "requeue-failed",
+                                            "failures"])
+    parser.add_argument("output_directory", help="Analysis output directory")
+    args = parser.parse_args()
+
+    fpath = job_queue_fpath(args.output_directory)
+    if not os.path.isfile(fpath):
+        parser.error("No job queue in {}".format(args.output_directory))
+    queue = JobQueue(fpath)
+    try:
+        if args.command == "status":
+            print(format_status(queue.status()))
+        elif args.command == "requeue-failed":
+            print("Requeued {} jobs".format(queue.requeue_failed()))
+        else:
+            print(json.dumps(queue.failures(), indent=2))
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()
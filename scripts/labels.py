@@ -0,0 +1,66 @@
+"""Primitives for working with label volumes.
+
+A label volume is an integer array in which each voxel holds the identifier
+of the region it belongs to and 0 denotes background.
+"""
+
+import numpy as np
+
+# Largest label for which a direct lookup table is used instead of sorting.
+MAX_DENSE_LABEL = 2**24
+
+
+def label_index(labels):
+    """Return (identifiers, index) tuple for a label volume.
+
+    identifiers is a sorted array of the non-zero labels present in the
+    volume. index is an array with the same shape as labels in which every
+    voxel holds the one based position of its label in identifiers, or 0 for
+    background. The index can be used directly with np.bincount.
+    """
+    labels = np.asarray(labels)
+    if labels.size == 0:
+        return np.zeros(0, dtype=labels.dtype), np.zeros(labels.shape,
+                                                         dtype=np.intp)
+
+    max_label = int(labels.max())
+    if max_label <= MAX_DENSE_LABEL:
+        flat = labels.ravel().astype(np.intp)
+        counts = np.bincount(flat, minlength=max_label + 1)
+        identifiers = np.flatnonzero(counts[1:]) + 1
+        lut = np.zeros(max_label + 1, dtype=np.intp)
+        lut[identifiers] = np.arange(1, len(identifiers) + 1)
+        index = lut[flat].reshape(labels.shape)
+        return identifiers.astype(labels.dtype), index
+
+    identifiers, inverse = np.unique(labels, return_inverse=True)
+    inverse = inverse.astype(np.intp).reshape(labels.shape)
+    if identifiers[0] == 0:
+        return identifiers[1:], inverse
+    return identifiers, inverse + 1
+
+
+def drop_labels(labels, identifiers):
+    """Set the voxels of all the given identifiers to background in place.
+
+    A boolean lookup table from label to drop-or-keep is built once and
+    applied to the volume in a single vectorised pass, rather than comparing
+    the whole volume against each identifier in turn.
+    """
+    if isinstance(identifiers, (set, frozenset)):
+        identifiers = list(identifiers)
+    identifiers = np.unique(np.asarray(identifiers, dtype=np.int64))
+    identifiers = identifiers[identifiers > 0]
+    if len(identifiers) == 0 or labels.size == 0:
+        return labels
+
+    max_label = int(labels.max())
+    identifiers = identifiers[identifiers <= max_label]
+    if max_label <= MAX_DENSE_LABEL:
+        lut = np.zeros(max_label + 1, dtype=bool)
+        lut[identifiers] = True
+        drop = lut[labels]
+    else:
+        drop = np.isin(labels, identifiers)
+    labels[drop] = 0
+    return labels
@@ -0,0 +1,162 @@
+"""Compact chunked file format for label volumes.
+
+A label volume file stores a segmentation as zlib compressed chunks of
+z-slices, together with the cell information, in a single file:
+
+    MAGIC | chunk 0 | chunk 1 | ... | JSON footer | footer length (8 bytes)
+
+The footer records the shape and dtype of the volume, the number of z-slices
+per chunk, the byte offset and length of each chunk and the cell information.
+Labels are stored as uint16 if they fit and uint32 otherwise.
+
+The file is memory mapped when read, so that individual z-ranges or cell
+bounding boxes can be read by decompressing only the chunks that overlap
+them. Chunks span whole z-slices, so only the z extent of a bounding box
+limits the data decompressed; reading a small box costs as much as reading
+its z-range.
+
+Usage:
+
+    write_label_volume("segmented.lvol", segmentation, cellinfo)
+
+    volume = LabelVolume("segmented.lvol")
+    stack = volume.read_zrange(10, 20)
+    cell = volume.read_bbox((10, 20, 5), (50, 60, 15))
+
+"""
+
+import os
+import mmap
+import zlib
+import json
+import struct
+
+import numpy as np
+
+LABEL_VOLUME_EXT = ".lvol"
+MAGIC = b"LVOL0001"
+FOOTER_LENGTH = struct.Struct("<Q")
+
+
+def label_dtype(labels):
+    """Return the smallest of uint16 and uint32 that can hold the labels."""
+    if labels.size and int(labels.max()) > np.iinfo(np.uint16).max:
+        return np.dtype(np.uint32)
+    return np.dtype(np.uint16)
+
+
+def write_label_volume(fpath, labels, cellinfo=None, chunk_depth=8,
+                       compression_level=6):
+    """Write (ydim, xdim, zdim) label array to a label volume file.
+
+    The file is written to a temporary path and renamed into place so that
+    readers never see a partially written volume.
+    """
+    labels = np.asarray(labels)
+    if labels.size and int(labels.min()) < 0:
+        raise ValueError("Labels must not be negative")
+    if labels.size and int(labels.max()) > np.iinfo(np.uint32).max:
+        raise ValueError("Labels must fit in uint32")
+    dtype = label_dtype(labels)
+    ydim, xdim, zdim = labels.shape
+
+    chunks = []
+    tmp_fpath = "{}.{}.tmp".format(fpath, os.getpid())
+    with open(tmp_fpath, "wb") as fh:
+        fh.write(MAGIC)
+        offset = len(MAGIC)
+        for z0 in range(0, zdim, chunk_depth):
+            z1 = min(z0 + chunk_depth, zdim)
+            chunk = labels[:, :, z0:z1].astype(dtype)
+            data = zlib.compress(np.ascontiguousarray(chunk).tobytes(),
+                                 compression_level)
+            fh.write(data)
+            chunks.append([z0, z1, offset, len(data)])
+            offset += len(data)
+
+        footer = {"shape": [ydim, xdim, zdim],
+                  "dtype": dtype.str,
+                  "chunks": chunks,
+                  "cellinfo": cellinfo}
+        footer = json.dumps(footer).encode("utf-8")
+        fh.write(footer)
+        fh.write(FOOTER_LENGTH.pack(len(footer)))
+    os.rename(tmp_fpath, fpath)
+
+
+def is_label_volume(fpath):
+    """Return True if fpath is a label volume file."""
+    if not os.path.isfile(fpath):
+        return False
+    with open(fpath, "rb") as fh:
+        return fh.read(len(MAGIC)) == MAGIC
+
+
+class LabelVolume(object):
+    """Read access to a label volume file."""
+
+    def __init__(self, fpath):
+        self.fpath = fpath
+        with open(fpath, "rb") as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise(ValueError("Not a label volume: {}".format(fpath)))
+        end = len(self._mmap) - FOOTER_LENGTH.size
+        footer_length, = FOOTER_LENGTH.unpack(self._mmap[end:])
+        footer = json.loads(
+            self._mmap[end - footer_length:end].decode("utf-8"))
+        self.shape = tuple(footer["shape"])
+        self.dtype = np.dtype(footer["dtype"])
+        self.cellinfo = footer["cellinfo"]
+        self._chunks = footer["chunks"]
+
+    def close(self):
+        self._mmap.close()
+
+    def _read_chunk(self, chunk):
+        z0, z1, offset, length = chunk
+        data = zlib.decompress(self._mmap[offset:offset + length])
+        ydim, xdim, _ = self.shape
+        return np.frombuffer(data, dtype=self.dtype).reshape(ydim, xdim,
+                                                             z1 - z0)
+
+    def read_zrange(self, zstart, zstop):
+        """Return labels for z-slices zstart up to, not including, zstop."""
+        ydim, xdim, zdim = self.shape
+        zstart, zstop = max(zstart, 0), min(zstop, zdim)
+        labels = np.zeros((ydim, xdim, max(zstop - zstart, 0)),
+                          dtype=self.dtype)
+        for chunk in self._chunks:
+            z0, z1 = chunk[0], chunk[1]
+            if z1 <= zstart or z0 >= zstop:
+                continue
+            lo, hi = max(z0, zstart), min(z1, zstop)
+            data = self._read_chunk(chunk)
+            labels[:, :, lo - zstart:hi - zstart] = data[:, :, lo - z0:hi - z0]
+        return labels
+
+    def read_bbox(self, bbox_min, bbox_max):
+        """Return labels within bounding box, bbox_max is exclusive.
+
+        The whole z-slices of the chunks overlapping the box are
+        decompressed, but only the box is kept in memory.
+        """
+        (y0, x0, z0), (y1, x1, z1) = bbox_min, bbox_max
+        ydim, xdim, zdim = self.shape
+        y0, y1 = max(y0, 0), min(y1, ydim)
+        x0, x1 = max(x0, 0), min(x1, xdim)
+        z0, z1 = max(z0, 0), min(z1, zdim)
+        labels = np.zeros((max(y1 - y0, 0), max(x1 - x0, 0),
+                           max(z1 - z0, 0)), dtype=self.dtype)
+        for chunk in self._chunks:
+            c0, c1 = chunk[0], chunk[1]
+            if c1 <= z0 or c0 >= z1:
+                continue
+            lo, hi = max(c0, z0), min(c1, z1)
+            data = self._read_chunk(chunk)
+            labels[:, :, lo - z0:hi - z0] = data[y0:y1, x0:x1, lo - c0:hi - c0]
+        return labels
+
+    def read(self):
+        """Return the full label array."""
+        return self.read_zrange(0, self.shape[2])
@@ -0,0 +1,130 @@
+"""Completion manifests for series output directories.
+
+A manifest is written to a series output directory once the analysis of the
+series has finished. It records what the output was produced from so that
+reruns can skip series that are complete and current:
+
+- input_hash: SHA-1 hash of the input microscopy file
+- series: the series identifier
+- version: the version of the analysis pipeline
+- parameters: the analysis parameters
+"""
+
+import os
+import json
+import hashlib
+import logging
+
+MANIFEST_FNAME = "manifest.json"
+
+_HASH_CACHE = {}
+
+
+def _read_hash_cache(cache_fpath):
+    try:
+        with open(cache_fpath) as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _write_hash_cache(cache_fpath, name, record):
+    """Atomically add a digest record to a hash cache file.
+
+    Records written by other processes in the meantime may be lost, which
+    only means that the file is hashed again.
+    """
+    records = _read_hash_cache(cache_fpath)
+    records[name] = record
+    tmp_fpath = "{}.{}.tmp".format(cache_fpath, os.getpid())
+    try:
+        with open(tmp_fpath, "w") as fh:
+            json.dump(records, fh, indent=2, sort_keys=True)
+        os.rename(tmp_fpath, cache_fpath)
+    except (IOError, OSError) as e:
+        logging.warning("Could not write hash cache {}: {}".format(
+            cache_fpath, e))
+
+
+def file_hash(fpath, block_size=2**20, algorithm="sha1", cache_fpath=None):
+    """Return hex digest of the file contents, SHA-1 by default.
+
+    Digests are cached per process, keyed by path, size and modification
+    time, so that the many series in a file only pay for hashing once. If
+    cache_fpath is given the digests are also stored in that JSON file, so
+    that later processes do not hash an unchanged file again.
+    """
+    stat = os.stat(fpath)
+    abspath = os.path.abspath(fpath)
+    key = (abspath, stat.st_size, stat.st_mtime, algorithm)
+    if key in _HASH_CACHE:
+        return _HASH_CACHE[key]
+
+    name = "{}:{}".format(algorithm, abspath)
+    if cache_fpath is not None:
+        record = _read_hash_cache(cache_fpath).get(name)
+        if record is not None and record["size"] == stat.st_size \
+                and record["mtime"] == stat.st_mtime:
+            _HASH_CACHE[key] = record["digest"]
+            return _HASH_CACHE[key]
+
+    digest = hashlib.new(algorithm)
+    with open(fpath, "rb") as fh:
+        for block in iter(lambda: fh.read(block_size), b""):
+            digest.update(block)
+    _HASH_CACHE[key] = digest.hexdigest()
+    if cache_fpath is not None:
+        _write_hash_cache(cache_fpath, name, {"size": stat.st_size,
+                                              "mtime": stat.st_mtime,
+                                              "digest": _HASH_CACHE[key]})
+    return _HASH_CACHE[key]
+
+
+def create_manifest(input_fpath, series, version, parameters,
+                    hash_cache_fpath=None):
+    """Return manifest dictionary for the analysis of a series.
+
+    The digest of the input file is stored in hash_cache_fpath if given, see
+    file_hash.
+    """
+    manifest = {"input_hash": file_hash(input_fpath,
+                                        cache_fpath=hash_cache_fpath),
+                "series": series,
+                "version": version,
+                "parameters": parameters}
+    # Round trip through JSON so that it compares equal to a manifest read
+    # from disk.
+    return json.loads(json.dumps(manifest))
+
+
+def read_manifest(directory):
+    """Return manifest in directory or None if there is no valid manifest."""
+    fpath = os.path.join(directory, MANIFEST_FNAME)
+    try:
+        with open(fpath) as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_manifest(directory, manifest):
+    """Atomically write manifest to directory."""
+    fpath = os.path.join(directory, MANIFEST_FNAME)
+    tmp_fpath = fpath + ".tmp"
+    with open(tmp_fpath, "w") as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.rename(tmp_fpath, fpath)
+
+
+def remove_manifest(directory):
+    """Remove manifest from directory, marking it as incomplete."""
+    fpath = os.path.join(directory, MANIFEST_FNAME)
+    if os.path.isfile(fpath):
+        os.remove(fpath)
+
+
+def is_current(directory, expected):
+    """Return True if directory has a manifest matching the expected one."""
+    return read_manifest(directory) == expected
@@ -1,9 +1,26 @@
-"""Mass process data in sequential fashion."""
+"""Mass process data in sequential or parallel fashion."""
 
+import os
+import json
+import time
+import socket
+import logging
 import argparse
+import traceback
+import multiprocessing
+
+from jicbioimage.core.io import AutoWrite
 
 from setup_image_data import unpack_series_in_single_file, unpack_all_series_in_directory
-from analyse_series import analyse_file
+from analyse_series import analyse_file, DEFAULT_PARAMETERS
+from omexml import get_omexml, OMEXML_CACHE_DIRNAME
+from profiling import write_profile_summary
+from segment import set_itk_threads
+from jobqueue import JobQueue, job_queue_fpath, format_status
+
+FAILED_JOBS_FNAME = "failed_jobs.json"
+POLL_SECONDS = 1.0
+
 
 def in_memory(input_file, output_directory):
 
@@ -24,11 +41,317 @@ def bash_script(input_file, output_directory):
         print(" ".join(cmd) + if_fails)
 
 
+def _init_worker(memory_limit_mb, itk_threads=None):
+    """Configure a freshly started worker process."""
+    AutoWrite.on = False
+    set_itk_threads(itk_threads)
+    if memory_limit_mb is not None:
+        # Cap the data segment rather than the address space, which the
+        # bfconvert JVM reserves far more of than it uses.
+        import resource
+        limit = int(memory_limit_mb) * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_DATA, (limit, limit))
+
+
+def _run_job(job, backend_dir, low_memory=False, parameters=None):
+    """Analyse a single series; return (job, error) tuple.
+
+    error is None if the analysis succeeded and the formatted traceback
+    otherwise. Exceptions are not propagated so that one failing series does
+    not bring down the other jobs; KeyboardInterrupt and SystemExit are.
+    """
+    fpath, series, output_path = job
+    handler = logging.FileHandler(os.path.join(output_path, "audit.log"))
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+    root_logger.setLevel(logging.INFO)
+    try:
+        analyse_file(fpath, output_path, series, backend_dir,
+                     parameters=parameters, low_memory=low_memory)
+        return job, None
+    except Exception:
+        logging.exception("Analysis failed")
+        return job, traceback.format_exc()
+    finally:
+        root_logger.removeHandler(handler)
+        handler.close()
+
+
+def write_failed_jobs(fpath, failures, attempts):
+    """Write JSON manifest describing the jobs that failed."""
+    manifest = []
+    for (input_fpath, series, output_path), error in failures:
+        manifest.append({"fpath": input_fpath,
+                         "series": series,
+                         "output_path": output_path,
+                         "attempts": attempts,
+                         "error": error})
+    with open(fpath, "w") as fh:
+        json.dump(manifest, fh, indent=2)
+
+
+def _run_job_process(connection, job, backend_dir, low_memory, parameters,
+                     memory_limit_mb, itk_threads):
+    """Analyse a job in a child process; send the error back."""
+    _init_worker(memory_limit_mb, itk_threads)
+    _, error = _run_job(job, backend_dir, low_memory, parameters)
+    connection.send(error)
+    connection.close()
+
+
+class JobProcess(object):
+    """Child process analysing a single series.
+
+    The child sends the error of the analysis, or None, back through a pipe.
+    A child that dies without sending it, e.g. because the kernel killed it
+    when the node ran out of memory, fails with its exit code.
+    """
+
+    def __init__(self, job, backend_dir, low_memory=False, parameters=None,
+                 memory_limit_mb=None, itk_threads=None):
+        self.job = job
+        self.error = None
+        self._finished = False
+        self._receiver, sender = multiprocessing.Pipe(duplex=False)
+        self._process = multiprocessing.Process(
+            target=_run_job_process,
+            args=(sender, job, backend_dir, low_memory, parameters,
+                  memory_limit_mb, itk_threads))
+        self._process.start()
+        sender.close()
+
+    def poll(self, timeout=0):
+        """Wait up to timeout seconds; return True if the job finished."""
+        if self._finished:
+            return True
+        # The pipe is read as soon as it is ready, so that a large
+        # traceback cannot block the child on a full pipe buffer.
+        if not self._receiver.poll(timeout):
+            return False
+        try:
+            self.error = self._receiver.recv()
+        except EOFError:
+            pass
+        self._receiver.close()
+        self._process.join()
+        if self._process.exitcode != 0 and self.error is None:
+            self.error = "Worker process exited with code {}".format(
+                self._process.exitcode)
+        self._finished = True
+        return True
+
+    def terminate(self):
+        """Stop the child if it is still running."""
+        if not self._finished:
+            self._process.terminate()
+            self._process.join()
+            self._receiver.close()
+            self._finished = True
+
+
+def run_parallel(process_list, backend_dir, workers=None, memory_limit_mb=None,
+                 retries=1, low_memory=False, itk_threads=None):
+    """Analyse all jobs in process_list in parallel worker processes.
+
+    Each series is analysed in a fresh worker process so that memory is
+    returned to the operating system between series. If memory_limit_mb is
+    given the data segment of each worker is capped, turning runaway series
+    into failures rather than exhausting the node. Workers that die, e.g.
+    because they were killed for running out of memory, fail their job
+    instead of stalling the run. Failed jobs are retried up to retries
+    times. If low_memory is True the channels are memory mapped from the
+    backend. itk_threads is the number of SimpleITK threads per worker, by
+    default the cores divided between the workers.
+
+    Returns list of ((fpath, series, output_path), error) tuples for the jobs
+    that failed in every attempt.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if itk_threads is None:
+        itk_threads = max(1, multiprocessing.cpu_count() // workers)
+
+    pending = list(process_list)
+    failures = []
+    for attempt in range(retries + 1):
+        if not pending:
+            break
+        if attempt > 0:
+            logging.info("Retrying {} failed jobs".format(len(pending)))
+        failures = []
+        running = []
+        try:
+            while pending or running:
+                while pending and len(running) < workers:
+                    running.append(JobProcess(pending.pop(0), backend_dir,
+                                              low_memory, None,
+                                              memory_limit_mb, itk_threads))
+                finished = [p for p in running if p.poll()]
+                if not finished:
+                    time.sleep(POLL_SECONDS)
+                for process in finished:
+                    running.remove(process)
+                    if process.error is not None:
+                        failures.append((process.job, process.error))
+        finally:
+            for process in running:
+                process.terminate()
+        pending = [job for job, error in failures]
+
+    return failures
+
+
+def queue_worker(queue_fpath, low_memory=False, memory_limit_mb=None,
+                 itk_threads=None, retries=1):
+    """Analyse jobs claimed from a job queue until none are left.
+
+    Each job is run in a child process, so that a series that crashes or
+    exhausts the memory of its process does not take the worker with it.
+    The lease of the job is extended while the child runs. The worker keeps
+    polling while other workers have jobs running, since their jobs return
+    to the queue if those workers die. Failed jobs are retried up to retries
+    times. If the lease is lost, the job may have been claimed by another
+    worker, so the child is stopped and the job left to that worker.
+    """
+    queue = JobQueue(queue_fpath, max_attempts=retries + 1)
+    worker = "{}:{}".format(socket.gethostname(), os.getpid())
+    poll_seconds = queue.lease_seconds / 10.0
+    try:
+        while True:
+            job = queue.claim(worker)
+            if job is None:
+                if not queue.unfinished():
+                    break
+                time.sleep(poll_seconds)
+                continue
+
+            process = JobProcess(
+                (job["fpath"], job["series"], job["output_path"]),
+                job["backend_dir"], low_memory, job["parameters"],
+                memory_limit_mb, itk_threads)
+            lost = False
+            try:
+                while not process.poll(poll_seconds):
+                    if not queue.heartbeat(job["id"], worker):
+                        logging.warning("Lost lease on job {}, stopping "
+                                        "it".format(job["id"]))
+                        lost = True
+                        break
+            finally:
+                process.terminate()
+            if lost:
+                continue
+            error = process.error
+
+            if error is None:
+                queue.complete(job["id"], worker)
+            else:
+                queue.fail(job["id"], worker, error)
+    finally:
+        queue.close()
+
+
+def run_queue_workers(queue_fpath, workers=None, low_memory=False,
+                      memory_limit_mb=None, itk_threads=None, retries=1):
+    """Run worker processes pulling jobs from a job queue; wait for them."""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if itk_threads is None:
+        itk_threads = max(1, multiprocessing.cpu_count() // workers)
+    processes = [multiprocessing.Process(target=queue_worker,
+                                         args=(queue_fpath, low_memory,
+                                               memory_limit_mb, itk_threads,
+                                               retries))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def job_queue(input_path, output_directory, workers=None, memory_limit_mb=None,
+              retries=1, low_memory=False, itk_threads=None, priority=0,
+              enqueue=True):
+    """Add the series of the input to the job queue and work on the queue.
+
+    Several hosts sharing the output directory can run this on the same
+    input. Series whose output is not current are queued; jobs of them
+    already in the queue are returned to it with the current parameters
+    unless they are running. If enqueue is False the workers only pull jobs
+    from the existing queue.
+    """
+    queue_fpath = job_queue_fpath(output_directory)
+    if enqueue:
+        if os.path.isdir(input_path):
+            backend_dir, process_list = unpack_all_series_in_directory(input_path, output_directory)
+        else:
+            backend_dir, process_list = unpack_series_in_single_file(input_path, output_directory)
+        for fpath in set(job[0] for job in process_list):
+            get_omexml(fpath, os.path.join(backend_dir, OMEXML_CACHE_DIRNAME))
+        queue = JobQueue(queue_fpath)
+        try:
+            queued = queue.add(process_list, backend_dir, DEFAULT_PARAMETERS,
+                               priority)
+        finally:
+            queue.close()
+        logging.info("Queued {} jobs in {}".format(queued, queue_fpath))
+
+    run_queue_workers(queue_fpath, workers, low_memory, memory_limit_mb,
+                      itk_threads, retries)
+
+    queue = JobQueue(queue_fpath)
+    try:
+        print(format_status(queue.status()))
+    finally:
+        queue.close()
+    write_profile_summary(output_directory)
+
+
+def parallel(input_path, output_directory, workers=None, memory_limit_mb=None,
+             retries=1, low_memory=False, itk_threads=None):
+    if os.path.isdir(input_path):
+        backend_dir, process_list = unpack_all_series_in_directory(input_path, output_directory)
+    else:
+        backend_dir, process_list = unpack_series_in_single_file(input_path, output_directory)
+
+    # Extract the metadata once per file before the workers start so that
+    # they all share the cached OME XML.
+    for fpath in set(job[0] for job in process_list):
+        get_omexml(fpath, os.path.join(backend_dir, OMEXML_CACHE_DIRNAME))
+
+    failures = run_parallel(process_list, backend_dir, workers,
+                            memory_limit_mb, retries, low_memory,
+                            itk_threads)
+
+    failed_jobs_fpath = os.path.join(output_directory, FAILED_JOBS_FNAME)
+    write_failed_jobs(failed_jobs_fpath, failures, retries + 1)
+    if failures:
+        logging.warning("{} of {} jobs failed, see {}".format(
+            len(failures), len(process_list), failed_jobs_fpath))
+
+    write_profile_summary(output_directory)
+
+
 def main():
     parser = argparse.ArgumentParser(__doc__)
     parser.add_argument('input_file', help='Path to input image file')
     parser.add_argument('output_directory', help='Path to output directory for analysis.')
-    parser.add_argument('type', choices=["bash-script", "in-memory-python"])
+    parser.add_argument('type', choices=["bash-script", "in-memory-python", "parallel-python",
+                                             "job-queue"])
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--memory-limit', type=int, default=None,
+                        help='Memory budget per worker process in MB')
+    parser.add_argument('--retries', type=int, default=1,
+                        help='Number of times to retry failed jobs')
+    parser.add_argument('--low-memory', default=False, action='store_true',
+                        help='Memory map the channels from the backend')
+    parser.add_argument('--itk-threads', type=int, default=None,
+                        help='SimpleITK threads per worker (default: CPUs / workers)')
+    parser.add_argument('--priority', type=int, default=0,
+                        help='Priority of the jobs added to the job queue')
+    parser.add_argument('--join', default=False, action='store_true',
+                        help='Only work on jobs already in the job queue')
 
     args = parser.parse_args()
 
@@ -36,6 +359,14 @@ def main():
         in_memory(args.input_file, args.output_directory)
     elif args.type == "bash-script":
         bash_script(args.input_file, args.output_directory)
+    elif args.type == "parallel-python":
+        parallel(args.input_file, args.output_directory, args.workers,
+                 args.memory_limit, args.retries, args.low_memory,
+                 args.itk_threads)
+    elif args.type == "job-queue":
+        job_queue(args.input_file, args.output_directory, args.workers,
+                  args.memory_limit, args.retries, args.low_memory,
+                  args.itk_threads, args.priority, enqueue=not args.join)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,26 @@
+"""Names of the per cell intensity measurements.
+
+A measurement applies a reducer to the voxel intensities of each cell in one
+channel and is named "c<channel>_<reducer>", e.g. c0_median. See
+cellinfo.cell_table for the reducers.
+
+Neighbour statistics, see adjacency.py, are named after the measurement they
+average over the neighbours of each cell, e.g. neighbour_c0_mean.
+"""
+
+DEFAULT_CHANNELS = (0, 1)
+DEFAULT_REDUCERS = ("mean", "median", "p10", "p90", "std",
+                    "mean_bgsub", "median_bgsub")
+NEIGHBOUR_MEASUREMENTS = ("c0_mean", "c1_mean")
+NEIGHBOUR_COLUMNS = ("num_neighbours", "wall_area") + tuple(
+    "neighbour_" + name for name in NEIGHBOUR_MEASUREMENTS)
+
+
+def measurement_name(channel, reducer):
+    """Return name of the measurement of a reducer on a channel."""
+    return "c{}_{}".format(channel, reducer)
+
+
+def measurement_names(channels, reducers):
+    """Return list of the measurement names of all channels and reducers."""
+    return [measurement_name(c, r) for c in channels for r in reducers]
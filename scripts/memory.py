@@ -0,0 +1,50 @@
+"""Measure the memory used by the stages of the analysis.
+
+Peak resident set size (RSS) is read from /proc/self/status. On Linux the
+peak is reset at the start of each stage by writing to /proc/self/clear_refs,
+so that the peak reported for a stage is the peak during that stage. Where
+this is not possible the peak since the start of the process is reported.
+
+Usage:
+
+    reset_peak_rss()
+    segmentation = segment(stack)
+    print(peak_rss())
+
+"""
+
+import resource
+
+PROC_STATUS = "/proc/self/status"
+PROC_CLEAR_REFS = "/proc/self/clear_refs"
+
+
+def _proc_status_kb(field):
+    """Return value of a kB field in /proc/self/status or None."""
+    try:
+        with open(PROC_STATUS) as fh:
+            for line in fh:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def peak_rss():
+    """Return peak resident set size in bytes."""
+    kb = _proc_status_kb("VmHWM")
+    if kb is None:
+        # ru_maxrss is in kB on Linux.
+        kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return kb * 1024
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size; return True if successful."""
+    try:
+        with open(PROC_CLEAR_REFS, "w") as fh:
+            fh.write("5")
+    except (IOError, OSError):
+        return False
+    return True
@@ -7,17 +7,25 @@ Uses showinf command below to generate the OME XML:
 The intent of the code is for the Python layer to abstract away the pain of
 having to interact directly with XML.
 
+The OME XML is extracted once per file. If a cache directory is given it is
+stored there, keyed by the path, size and modification time of the
+microscopy file, so that it can be shared between processes. Within a
+process parsed instances are reused.
+
 Usage:
 
-    omexml = OmeXml(microscopy_fpath)
+    omexml = get_omexml(microscopy_fpath, cache_directory)
     series3 = omexml.series(3)
     print series3.identifier, series3.name
+    print series3.physical_size
     for child in series3.element:
         print child.tag, child.attrib
 
 """
 
+import os
 import sys
+import hashlib
 from subprocess import Popen, PIPE
 
 try:
@@ -25,6 +33,8 @@ try:
 except ImportError:
     import xml.etree.ElementTree as ET
 
+OMEXML_CACHE_DIRNAME = ".omexml"
+
 OME_SCHEMA = "{http://www.openmicroscopy.org/Schemas/OME/2016-06}"
 
 
@@ -51,17 +61,83 @@ class Series(object):
         """Return series name."""
         return self.element.attrib["Name"]
 
+    @property
+    def pixels(self):
+        """Return the Pixels element of the series."""
+        return self.element.find(tag("Pixels"))
+
+    @property
+    def physical_size(self):
+        """Return (x, y, z) voxel size; dimensions without a size are None."""
+        attrib = self.pixels.attrib
+
+        def size(key):
+            value = attrib.get(key)
+            return None if value is None else float(value)
+
+        return size("PhysicalSizeX"), size("PhysicalSizeY"), size("PhysicalSizeZ")
+
+    @property
+    def physical_size_unit(self):
+        """Return unit of the physical voxel size."""
+        return self.pixels.attrib.get("PhysicalSizeXUnit", u"\u00b5m")
+
+    @property
+    def channels(self):
+        """Return list of dictionaries with channel attributes."""
+        return [dict(c.attrib) for c in self.pixels.iter(tag("Channel"))]
+
+
+def _cache_fpath(fpath, cache_directory):
+    """Return path of the cached OME XML for a microscopy file."""
+    stat = os.stat(fpath)
+    key = "{}:{}:{}".format(os.path.abspath(fpath), stat.st_size,
+                            stat.st_mtime)
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+    return os.path.join(cache_directory, digest + ".xml")
+
+
+def extract_xml(fpath):
+    """Return OME XML extracted from microscopy file using showinf."""
+    cmd = ["showinf", "-nopix", "-omexml-only", fpath]
+    p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    xml, err = p.communicate()
+    if err:
+        raise(RuntimeError("\nshowinf issue:\n{}".format(err)))
+    return xml
+
+
+def cached_xml(fpath, cache_directory):
+    """Return OME XML, extracting it only if it is not in the cache."""
+    cache_fpath = _cache_fpath(fpath, cache_directory)
+    if os.path.isfile(cache_fpath):
+        with open(cache_fpath, "rb") as fh:
+            return fh.read()
+
+    xml = extract_xml(fpath)
+    if not os.path.isdir(cache_directory):
+        try:
+            os.makedirs(cache_directory)
+        except OSError:
+            if not os.path.isdir(cache_directory):
+                raise
+    tmp_fpath = "{}.{}.tmp".format(cache_fpath, os.getpid())
+    with open(tmp_fpath, "wb") as fh:
+        fh.write(xml)
+    os.rename(tmp_fpath, cache_fpath)
+    return xml
+
 
 class OmeXml(object):
     """Class for working with OME XML metadata."""
 
-    def __init__(self, fpath):
-        cmd = ["showinf", "-nopix", "-omexml-only", fpath]
-        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-        self.xml, err = p.communicate()
-        if err:
-            raise(RuntimeError("\nshowinf issue:\n{}".format(err)))
+    def __init__(self, fpath, cache_directory=None):
+        if cache_directory is None:
+            self.xml = extract_xml(fpath)
+        else:
+            self.xml = cached_xml(fpath, cache_directory)
         self.tree = ET.XML(self.xml)
+        self._series = dict((s.identifier, s) for s in self.series_iter())
 
     def series_iter(self):
         """Iterate over all the image series."""
@@ -70,6 +146,16 @@ class OmeXml(object):
 
     def series(self, identifier):
         """Return a specific image series."""
-        for s in self.series_iter():
-            if s.identifier == identifier:
-                return s
+        return self._series.get(identifier)
+
+
+_OMEXML_INSTANCES = {}
+
+
+def get_omexml(fpath, cache_directory=None):
+    """Return OmeXml instance, reusing one already parsed in this process."""
+    stat = os.stat(fpath)
+    key = (os.path.abspath(fpath), stat.st_size, stat.st_mtime)
+    if key not in _OMEXML_INSTANCES:
+        _OMEXML_INSTANCES[key] = OmeXml(fpath, cache_directory)
+    return _OMEXML_INSTANCES[key]
@@ -0,0 +1,119 @@
+"""Synthetic 3D root phantoms for benchmarking.
+
+A phantom is a cylindrical root running along the x axis that is filled with
+Voronoi cells. It consists of a cell wall channel, in which the faces between
+neighbouring cells are bright, an intensity channel, in which every cell has
+its own mean intensity, and the ground truth labels.
+"""
+
+import numpy as np
+import scipy.spatial
+
+from jicbioimage.core.image import Image3D
+
+
+def voronoi_labels(shape, num_cells, random_state):
+    """Return label volume of Voronoi cells with identifiers from 1."""
+    seeds = random_state.uniform(0, 1, size=(num_cells, 3)) * shape
+    tree = scipy.spatial.cKDTree(seeds)
+    labels = np.empty(shape, dtype=np.uint32)
+    ydim, xdim, zdim = shape
+    # Query one z-slice at a time to bound memory use.
+    yy, xx = np.mgrid[0:ydim, 0:xdim]
+    for z in range(zdim):
+        coords = np.column_stack([yy.ravel(), xx.ravel(),
+                                  np.full(yy.size, z)])
+        _, nearest = tree.query(coords)
+        labels[:, :, z] = nearest.reshape(ydim, xdim) + 1
+    return labels
+
+
+def root_mask(shape, radius_fraction=0.45):
+    """Return mask of a cylinder running along the x axis."""
+    ydim, xdim, zdim = shape
+    yy, zz = np.mgrid[0:ydim, 0:zdim]
+    cy, cz = (ydim - 1) / 2.0, (zdim - 1) / 2.0
+    ry, rz = radius_fraction * ydim, radius_fraction * zdim
+    section = ((yy - cy) / ry) ** 2 + ((zz - cz) / rz) ** 2 <= 1
+    return np.repeat(section[:, np.newaxis, :], xdim, axis=1)
+
+
+def cell_walls(labels):
+    """Return boolean array marking voxels adjacent to a different label."""
+    walls = np.zeros(labels.shape, dtype=bool)
+    for axis in range(labels.ndim):
+        lo = [slice(None)] * labels.ndim
+        hi = [slice(None)] * labels.ndim
+        lo[axis] = slice(None, -1)
+        hi[axis] = slice(1, None)
+        differ = labels[tuple(lo)] != labels[tuple(hi)]
+        walls[tuple(lo)] |= differ
+        walls[tuple(hi)] |= differ
+    return walls
+
+
+def root_phantom(shape=(256, 256, 32), num_cells=200, seed=0):
+    """Return (wall_stack, intensity_stack, labels) of a synthetic root."""
+    random_state = np.random.RandomState(seed)
+    shape = tuple(shape)
+    labels = voronoi_labels(shape, num_cells, random_state)
+    labels[~root_mask(shape)] = 0
+
+    walls = cell_walls(labels)
+    wall_stack = random_state.normal(20, 5, size=shape)
+    wall_stack[walls] += 180
+    wall_stack = np.clip(wall_stack, 0, 255).astype(np.uint8)
+
+    cell_means = random_state.uniform(20, 200, size=num_cells + 1)
+    cell_means[0] = 5
+    intensity_stack = cell_means[labels]
+    intensity_stack += random_state.normal(0, 10, size=shape)
+    intensity_stack = np.clip(intensity_stack, 0, 255).astype(np.uint8)
+
+    return (wall_stack.view(Image3D), intensity_stack.view(Image3D), labels)
+
+
+class PhantomPlaneProxy(object):
+    """Stand in for the image proxy of a z-slice in a MicroscopyCollection.
+
+    The plane is not backed by a file, so fpath is None.
+    """
+
+    fpath = None
+
+    def __init__(self, stack, series, channel, zslice, timepoint=0):
+        self._stack = stack
+        self.series = series
+        self.channel = channel
+        self.zslice = zslice
+        self.timepoint = timepoint
+
+    @property
+    def image(self):
+        return self._stack[:, :, self.zslice]
+
+
+class PhantomCollection(object):
+    """Stand in for a MicroscopyCollection holding a single phantom series.
+
+    Channel 1 is the cell wall channel and channel 0 the intensity channel,
+    as in the microscopy data. Iterating over the collection yields a proxy
+    per z-slice, as for a MicroscopyCollection.
+    """
+
+    def __init__(self, wall_stack, intensity_stack):
+        self._channels = {0: intensity_stack, 1: wall_stack}
+
+    def __iter__(self):
+        for c, stack in sorted(self._channels.items()):
+            for z in range(stack.shape[2]):
+                yield PhantomPlaneProxy(stack, 0, c, z)
+
+    def zstack_proxy_iterator(self, s=0, c=0, t=0):
+        for proxy in self:
+            if proxy.series == s and proxy.channel == c \
+                    and proxy.timepoint == t:
+                yield proxy
+
+    def zstack(self, s=0, c=0, t=0):
+        return self._channels[c].copy().view(Image3D)
@@ -0,0 +1,180 @@
+"""Incremental pipeline of analysis stages.
+
+A pipeline is a dependency graph of stages. The key of a stage is a SHA-1
+hash of its name, the pipeline version, its parameters and the keys of the
+stages it depends on. Stages that read the input pass a hash of the content
+of the input file as a parameter. A change anywhere upstream of a stage
+therefore changes its key.
+
+The keys of the stages that finished are recorded in stages.json in the
+output directory. When the pipeline is run again, a stage is only run if
+its key changed or one of its output files is missing. Stages that are
+current are not run, and their results are loaded from their output files
+only if a stage that is run depends on them. Changing the filter parameters
+of a finished series, for example, reruns the filtering and the stages after
+it on the stored segmentation and cell info.
+
+Stages without output files are run when a stage that is run depends on
+them. The result of a stage is released once no stage left to run lists it
+in its dependencies.
+
+Usage:
+
+    pipeline = Pipeline(output_directory, version="0.4.0")
+    pipeline.add("segment", run_segment, parameters={"input_hash": digest},
+                 outputs=["segmented.lvol"], load=load_segmentation)
+    pipeline.add("filter", run_filter, depends=["segment"],
+                 parameters={"min_cell_size": 10000},
+                 outputs=["filtered.lvol"], load=load_filtered)
+    pipeline.run()
+"""
+
+import os
+import json
+import hashlib
+import logging
+from collections import OrderedDict
+
+STAGES_FNAME = "stages.json"
+
+
+def stage_key(name, version, parameters, dependency_keys):
+    """Return hex digest identifying a stage and everything upstream of it."""
+    text = json.dumps([name, version, parameters, list(dependency_keys)],
+                      sort_keys=True)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def read_stage_record(directory):
+    """Return dictionary of the stage keys recorded in directory."""
+    fpath = os.path.join(directory, STAGES_FNAME)
+    try:
+        with open(fpath) as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def write_stage_record(directory, record):
+    """Atomically write the stage keys to directory."""
+    fpath = os.path.join(directory, STAGES_FNAME)
+    tmp_fpath = "{}.{}.tmp".format(fpath, os.getpid())
+    with open(tmp_fpath, "w") as fh:
+        json.dump(record, fh, indent=2, sort_keys=True)
+    os.rename(tmp_fpath, fpath)
+
+
+class Stage(object):
+    """Stage of a pipeline."""
+
+    def __init__(self, name, run, depends, parameters, outputs, load, key):
+        self.name = name
+        self.run = run
+        self.depends = list(depends)
+        self.parameters = parameters
+        self.outputs = list(outputs)
+        self.load = load
+        self.key = key
+
+
+class Pipeline(object):
+    """Dependency graph of stages run incrementally in an output directory.
+
+    If directory is None no keys are recorded and every stage with output
+    files is run.
+    """
+
+    def __init__(self, directory=None, version=None):
+        self.directory = directory
+        self.version = version
+        self.stages = OrderedDict()
+        self._record = {}
+        if directory is not None:
+            self._record = read_stage_record(directory)
+        self._results = {}
+        self._done = set()
+
+    def add(self, name, run, depends=(), parameters=None, outputs=(),
+            load=None):
+        """Add a stage to the pipeline.
+
+        run is called with the results of the stages in depends, which must
+        already have been added. outputs are the paths of the files and
+        directories the stage writes, relative to the output directory.
+        load, if given, is called without arguments to read the result of
+        the stage back from its outputs.
+        """
+        if name in self.stages:
+            raise ValueError("Duplicate stage: {}".format(name))
+        for dependency in depends:
+            if dependency not in self.stages:
+                raise ValueError("Stage {} depends on unknown stage {}".format(
+                    name, dependency))
+        key = stage_key(name, self.version, parameters,
+                        [self.stages[d].key for d in depends])
+        self.stages[name] = Stage(name, run, depends, parameters, outputs,
+                                  load, key)
+
+    def is_current(self, name):
+        """Return True if a stage does not need to be run."""
+        stage = self.stages[name]
+        if self.directory is None or not stage.outputs:
+            return False
+        if self._record.get(name) != stage.key:
+            return False
+        return all(os.path.exists(os.path.join(self.directory, o))
+                   for o in stage.outputs)
+
+    def stale(self):
+        """Return list of the stages with outputs that need to be run."""
+        return [name for name, stage in self.stages.items()
+                if stage.outputs and not self.is_current(name)]
+
+    def _needed(self, remaining):
+        """Return set of the results the stages left to run depend on.
+
+        Only the stages in remaining and the stages without outputs that
+        have not been run yet can still be run.
+        """
+        return set(dependency for name, stage in self.stages.items()
+                   if name in remaining or
+                   (not stage.outputs and name not in self._done)
+                   for dependency in stage.depends)
+
+    def _result(self, name):
+        """Return result of a stage, loading it or running it as needed."""
+        if name in self._results:
+            return self._results[name]
+        stage = self.stages[name]
+        if stage.load is not None and self.is_current(name):
+            logging.info("Loading result of current stage {}".format(name))
+            result = stage.load()
+        else:
+            arguments = [self._result(d) for d in stage.depends]
+            logging.info("Running stage {}".format(name))
+            if self._record.pop(name, None) is not None:
+                # Outputs being rewritten must not be mistaken for current.
+                write_stage_record(self.directory, self._record)
+            result = stage.run(*arguments)
+            if self.directory is not None and stage.outputs:
+                self._record[name] = stage.key
+                write_stage_record(self.directory, self._record)
+        self._results[name] = result
+        self._done.add(name)
+        return result
+
+    def run(self):
+        """Run the stages that are not current; return their names."""
+        stale = self.stale()
+        for name in self.stages:
+            if name not in stale and self.stages[name].outputs:
+                logging.info("Skipping current stage {}".format(name))
+        remaining = list(stale)
+        for name in stale:
+            self._result(name)
+            remaining.remove(name)
+            needed = self._needed(remaining)
+            for done in list(self._results):
+                if done not in needed:
+                    del self._results[done]
+        return stale
@@ -0,0 +1,188 @@
+"""Per stage profiling of the analysis pipeline.
+
+A profile records, for every stage, the wall time, CPU time, peak resident
+set size and the shapes and dtypes of the input and output arrays. Stages can
+be nested; the peak RSS of a stage includes that of the stages within it.
+
+Usage:
+
+    profile = start_profile()
+    with profile_stage("segment", stack) as record:
+        segmentation = segment(stack)
+        record_output(record, segmentation)
+    stop_profile()
+    profile.write("profile.json")
+
+Functions can be profiled with the profiled decorator. Profiling stages are
+no-ops while no profile has been started.
+
+Profiles of many series can be aggregated per stage:
+
+    $ python scripts/profiling.py output_dir
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+import resource
+import functools
+import contextlib
+
+import numpy as np
+
+from memory import peak_rss, reset_peak_rss
+
+PROFILE_FNAME = "profile.json"
+PROFILE_SUMMARY_FNAME = "profile_summary.json"
+
+_ACTIVE = []
+
+
+def describe(value):
+    """Return dictionary describing shape and dtype of an array or None."""
+    if isinstance(value, np.ndarray):
+        return {"shape": list(value.shape), "dtype": str(value.dtype)}
+    return None
+
+
+def cpu_time():
+    """Return user plus system CPU time of the process, all threads."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Profile(object):
+    """Collection of per stage profiling records."""
+
+    def __init__(self):
+        self.records = []
+        self._open = []
+
+    @contextlib.contextmanager
+    def stage(self, name, *inputs):
+        """Context manager profiling a stage; yields the stage record."""
+        if self._open:
+            parent = self._open[-1]
+            parent["_peak"] = max(parent["_peak"], peak_rss())
+        reset_peak_rss()
+        record = {"stage": name,
+                  "parent": self._open[-1]["stage"] if self._open else None,
+                  "inputs": [d for d in map(describe, inputs) if d],
+                  "output": None,
+                  "_peak": 0}
+        self._open.append(record)
+        start_wall, start_cpu = time.time(), cpu_time()
+        try:
+            yield record
+        finally:
+            self._open.pop()
+            record["wall_time"] = time.time() - start_wall
+            record["cpu_time"] = cpu_time() - start_cpu
+            record["peak_rss"] = max(record.pop("_peak"), peak_rss())
+            if self._open:
+                parent = self._open[-1]
+                parent["_peak"] = max(parent["_peak"], record["peak_rss"])
+            self.records.append(record)
+            log = logging.debug if record["parent"] else logging.info
+            log("Stage {}: {:.1f}s wall, {:.1f}s CPU, "
+                "peak RSS {:.1f} MB".format(name,
+                                            record["wall_time"],
+                                            record["cpu_time"],
+                                            record["peak_rss"] / 2.0**20))
+
+    def write(self, fpath):
+        """Write the records to a JSON file."""
+        with open(fpath, "w") as fh:
+            json.dump(self.records, fh, indent=2)
+
+
+def start_profile():
+    """Start and return a new profile that stages are recorded in."""
+    profile = Profile()
+    _ACTIVE.append(profile)
+    return profile
+
+
+def stop_profile():
+    """Stop recording stages in the most recently started profile."""
+    return _ACTIVE.pop()
+
+
+@contextlib.contextmanager
+def profile_stage(name, *inputs):
+    """Profile a stage in the active profile, if any; yields its record."""
+    if not _ACTIVE:
+        yield None
+        return
+    with _ACTIVE[-1].stage(name, *inputs) as record:
+        yield record
+
+
+def record_output(record, output):
+    """Record the shape and dtype of the output of a stage."""
+    if record is not None:
+        record["output"] = describe(output)
+
+
+def profiled(func):
+    """Decorator profiling each call of func as a stage."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with profile_stage(func.__name__, *args) as record:
+            result = func(*args, **kwargs)
+            record_output(record, result)
+        return result
+    return wrapper
+
+
+def aggregate_profiles(directory):
+    """Return per stage summary of all the profiles below directory."""
+    summary = {}
+    num_profiles = 0
+    for dirpath, dirnames, fnames in os.walk(directory):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+        if PROFILE_FNAME not in fnames:
+            continue
+        with open(os.path.join(dirpath, PROFILE_FNAME)) as fh:
+            records = json.load(fh)
+        num_profiles += 1
+        for record in records:
+            stage = summary.setdefault(record["stage"], {"calls": 0,
+                                                         "wall_time": 0.0,
+                                                         "cpu_time": 0.0,
+                                                         "max_wall_time": 0.0,
+                                                         "max_peak_rss": 0})
+            stage["calls"] += 1
+            stage["wall_time"] += record["wall_time"]
+            stage["cpu_time"] += record["cpu_time"]
+            stage["max_wall_time"] = max(stage["max_wall_time"],
+                                         record["wall_time"])
+            stage["max_peak_rss"] = max(stage["max_peak_rss"],
+                                        record["peak_rss"])
+    for stage in summary.values():
+        stage["mean_wall_time"] = stage["wall_time"] / stage["calls"]
+    return {"profiles": num_profiles, "stages": summary}
+
+
+def write_profile_summary(directory):
+    """Aggregate profiles below directory into a summary JSON file."""
+    summary = aggregate_profiles(directory)
+    fpath = os.path.join(directory, PROFILE_SUMMARY_FNAME)
+    with open(fpath, "w") as fh:
+        json.dump(summary, fh, indent=2, sort_keys=True)
+    return fpath
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("directory", help="Analysis output directory")
+    args = parser.parse_args()
+    if not os.path.isdir(args.directory):
+        parser.error("Not a directory: " + args.directory)
+    print(write_profile_summary(args.directory))
+
+
+if __name__ == "__main__":
+    main()
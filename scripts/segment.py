@@ -1,126 +1,309 @@
 """Code for segmenting 3D images."""
 
+from multiprocessing.pool import ThreadPool
+
 import SimpleITK as sitk
 
 import numpy as np
+import scipy.ndimage
+import scipy.spatial
+import skimage.filters
 import skimage.morphology
 
 from jicbioimage.core.image import Image3D
 from jicbioimage.core.transform import transformation
-from jicbioimage.core.io import AutoWrite
-
-from jicbioimage.transform import (
-    threshold_otsu,
-    remove_small_objects,
-)
 
 from utils import ColorImage3D, PrettyColorImage3D
+from labels import drop_labels
+from cache import cached
+from profiling import profiled, profile_stage
 
 
 @transformation
+@profiled
 def identity(im3d):
     return im3d
 
 
-@transformation
-def pseudo_convex_hull(im3d):
-    stack = []
-    ydim, xdim, zdim = im3d.shape
-    for i in range(zdim):
-        slice_hull = skimage.morphology.convex_hull_image(im3d[:, :, i])
-        stack.append(slice_hull)
-    return np.dstack(stack).view(Image3D)
+MASK_HULLS = ("plane", "3d")
 
+_QhullError = getattr(scipy.spatial, "QhullError", None)
+if _QhullError is None:
+    _QhullError = scipy.spatial.qhull.QhullError
 
-@transformation
-def remove_small_objects_in_plane(im3d, min_size):
-    tmp_auto_write_on = AutoWrite.on
-    AutoWrite.on = False
-    stack = []
-    ydim, xdim, zdim = im3d.shape
-    for i in range(zdim):
-        slice_hull = remove_small_objects(im3d[:, :, i], min_size)
-        stack.append(slice_hull)
 
-    AutoWrite.on = tmp_auto_write_on
-    return np.dstack(stack).view(Image3D)
+def _thread_count():
+    """Return the number of threads a worker process may use."""
+    return sitk.ProcessObject.GetGlobalDefaultNumberOfThreads()
 
 
-@transformation
-def filter_median(im3d):
-    itk_im = sitk.GetImageFromArray(im3d)
-    median_filter = sitk.MedianImageFilter()
-    itk_im = median_filter.Execute(itk_im)
-    return Image3D.from_array(sitk.GetArrayFromImage(itk_im),
-                              log_in_history=False)
+def _map_planes(func, im3d, threads=None):
+    """Return stack of func applied to each z-slice, using a thread pool."""
+    planes = [im3d[:, :, i] for i in range(im3d.shape[2])]
+    pool = ThreadPool(threads or _thread_count())
+    try:
+        planes = pool.map(func, planes)
+    finally:
+        pool.close()
+        pool.join()
+    return np.dstack(planes)
 
 
-@transformation
-def gradient_magnitude(im3d):
-    itk_im = sitk.GetImageFromArray(im3d)
-    itk_im = sitk.GradientMagnitude(itk_im)
-    return Image3D.from_array(sitk.GetArrayFromImage(itk_im),
-                              log_in_history=False)
+def _plane_hull(plane):
+    """Return convex hull of a boolean z-slice; empty slices stay empty."""
+    if not plane.any():
+        return np.zeros(plane.shape, dtype=bool)
+    return skimage.morphology.convex_hull_image(plane)
+
+
+def _plane_remove_small_objects(plane, min_size):
+    """Return boolean z-slice without connected components below min_size."""
+    if not plane.any():
+        return np.zeros(plane.shape, dtype=bool)
+    return skimage.morphology.remove_small_objects(plane.astype(bool),
+                                                   min_size=min_size)
+
+
+def _hull_points(mask):
+    """Return (n, 3) coordinates of the mask voxels on the edge of a slice.
+
+    The vertices of the convex hull are always among these points.
+    """
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[:, :, 1] = True
+    edge = mask & ~scipy.ndimage.binary_erosion(mask, structure,
+                                                 border_value=0)
+    return np.argwhere(edge).astype(float)
+
+
+def _fill_convex_polygon(shape, points):
+    """Return boolean image of the convex hull of (n, 2) points."""
+    plane = np.zeros(shape, dtype=bool)
+    lo = np.maximum(np.floor(points.min(axis=0)).astype(int), 0)
+    hi = np.minimum(np.ceil(points.max(axis=0)).astype(int) + 1, shape)
+    try:
+        equations = scipy.spatial.ConvexHull(points).equations
+    except _QhullError:
+        # Degenerate section of the hull, e.g. a single edge; the hull of
+        # its pixels fills the segment between its end points.
+        index = np.round(points).astype(int)
+        plane[index[:, 0], index[:, 1]] = True
+        return _plane_hull(plane)
+    yy, xx = np.mgrid[lo[0]:hi[0], lo[1]:hi[1]]
+    grid = np.column_stack([yy.ravel(), xx.ravel()])
+    inside = np.all(np.dot(grid, equations[:, :2].T) + equations[:, 2] <= 1e-6,
+                    axis=1)
+    plane[lo[0]:hi[0], lo[1]:hi[1]] = inside.reshape(yy.shape)
+    return plane
+
+
+def convex_hull_3d(mask):
+    """Return the 3D convex hull of a boolean stack.
+
+    The hull is filled one z-slice at a time from its cross section with the
+    plane of the slice, so memory use is bounded by the size of a slice.
+    Masks confined to a single z-slice fall back to the hull of that slice.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    points = _hull_points(mask)
+    result = np.zeros(mask.shape, dtype=bool)
+    if len(points) == 0:
+        return result
+    try:
+        hull = scipy.spatial.ConvexHull(points)
+    except _QhullError:
+        return _map_planes(_plane_hull, mask)
+
+    vertices = hull.points[hull.vertices]
+    simplices = hull.simplices
+    edges = np.vstack([simplices[:, [0, 1]],
+                       simplices[:, [1, 2]],
+                       simplices[:, [0, 2]]])
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    start, end = hull.points[edges[:, 0]], hull.points[edges[:, 1]]
+
+    zmin, zmax = int(vertices[:, 2].min()), int(vertices[:, 2].max())
+    for z in range(zmin, zmax + 1):
+        crossing = (start[:, 2] - z) * (end[:, 2] - z) < 0
+        fraction = ((z - start[crossing, 2]) /
+                    (end[crossing, 2] - start[crossing, 2]))[:, np.newaxis]
+        section = start[crossing] + fraction * (end[crossing] - start[crossing])
+        section = np.vstack([section, vertices[vertices[:, 2] == z]])
+        if len(section) == 0:
+            continue
+        result[:, :, z] = _fill_convex_polygon(mask.shape[:2], section[:, :2])
+    return result
 
 
 @transformation
-def discrete_gaussian_filter(im3d, variance):
-    itk_im = sitk.GetImageFromArray(im3d)
+@profiled
+@cached(Image3D, helpers=(_map_planes, _plane_remove_small_objects,
+                          _plane_hull, convex_hull_3d, _hull_points,
+                          _fill_convex_polygon))
+def root_mask(im3d, min_size, hull):
+    """Return mask of the root; Otsu threshold, clean up and convex hull.
+
+    The clean up and, for the "plane" hull, the convex hull are applied to
+    each z-slice in turn by a pool of threads. For the "3d" hull the convex
+    hull of the cleaned up mask as a whole is used instead.
+    """
+    if hull not in MASK_HULLS:
+        raise ValueError("Unknown hull: {}".format(hull))
+    with profile_stage("threshold_otsu", im3d):
+        mask = im3d > skimage.filters.threshold_otsu(np.asarray(im3d))
+
+    def plane_mask(plane):
+        plane = _plane_remove_small_objects(plane, min_size)
+        if hull == "plane":
+            plane = _plane_hull(plane)
+        return plane
+
+    with profile_stage("mask_planes", mask):
+        mask = _map_planes(plane_mask, mask)
+    if hull == "3d":
+        with profile_stage("convex_hull_3d", mask):
+            mask = convex_hull_3d(mask)
+    return mask.view(Image3D)
+
+
+def set_itk_threads(threads):
+    """Set the number of threads used by the SimpleITK filters.
+
+    None leaves the ITK default, which is one thread per core. Worker
+    processes running side by side should share the cores between them.
+    """
+    if threads is not None:
+        sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(int(threads))
+
+
+def _to_itk(im3d):
+    """Return float32 SimpleITK image of a stack."""
+    return sitk.GetImageFromArray(np.ascontiguousarray(im3d,
+                                                       dtype=np.float32))
+
+
+def _from_itk(itk_im):
+    """Return Image3D sharing the buffer of a SimpleITK image if possible.
+
+    The view is read only and keeps a reference to the SimpleITK image so
+    that the buffer outlives it.
+    """
+    if not hasattr(sitk, "GetArrayViewFromImage"):
+        return Image3D.from_array(sitk.GetArrayFromImage(itk_im),
+                                  log_in_history=False)
+    array = sitk.GetArrayViewFromImage(itk_im).view(Image3D)
+    array.itk_image = itk_im
+    return Image3D.from_array(array, log_in_history=False)
+
+
+def _median(itk_im):
+    return sitk.MedianImageFilter().Execute(itk_im)
+
+
+def _gaussian(itk_im, variance):
     gaussian_filter = sitk.DiscreteGaussianImageFilter()
     gaussian_filter.SetVariance(variance)
-    itk_im = gaussian_filter.Execute(itk_im)
-    return Image3D.from_array(sitk.GetArrayFromImage(itk_im),
-                              log_in_history=False)
+    return gaussian_filter.Execute(itk_im)
 
 
 @transformation
+@profiled
+@cached(Image3D, helpers=(_to_itk, _median, _gaussian, _from_itk))
+def smoothed_gradient_magnitude(im3d, variance):
+    """Return Gaussian smoothed gradient magnitude of the median filtered stack.
+
+    The filters are chained in SimpleITK image space at float32 precision, so
+    the stack is only converted to and from NumPy once.
+    """
+    itk_im = _to_itk(im3d)
+    with profile_stage("filter_median"):
+        itk_im = _median(itk_im)
+    with profile_stage("gradient_magnitude"):
+        itk_im = sitk.GradientMagnitude(itk_im)
+    with profile_stage("discrete_gaussian_filter"):
+        itk_im = _gaussian(itk_im, variance)
+    return _from_itk(itk_im)
+
+
+@transformation
+@profiled
+@cached(ColorImage3D, helpers=(_to_itk,))
 def morphological_watershed(im3d, level):
-    itk_im = sitk.GetImageFromArray(im3d)
-    itk_im = sitk.MorphologicalWatershed(itk_im, level=level)
+    itk_im = sitk.MorphologicalWatershed(_to_itk(im3d), level=level)
+    # Copied, since the segmentation is filtered in place.
     return ColorImage3D.from_array(sitk.GetArrayFromImage(itk_im),
                                    log_in_history=False)
 
 
-@transformation
-def filter_cells_outside_mask(im3d, mask):
+def cells_outside_mask(im3d, mask):
+    """Return identifiers of segments that extend outside the mask."""
     inverse_mask = np.logical_not(mask)
-    ids_to_filter = np.unique(im3d * inverse_mask)
-    for i in ids_to_filter:
-        im3d[im3d == i] = 0
-    return im3d
+    return np.unique(np.asarray(im3d)[inverse_mask])
 
 
-@transformation
-def remove_border_segmentations(im3d):
-    """Remove segments that touch the image border."""
+def cells_touching_border(im3d):
+    """Return identifiers of segments that touch the image border."""
     ydim, xdim, zdim = im3d.shape
-
-    # Identify any segments that touch the image border.
     border_seg_ids = set()
     border_seg_ids.update(set(np.unique(im3d[0, :, :])))
     border_seg_ids.update(set(np.unique(im3d[:, 0, :])))
     border_seg_ids.update(set(np.unique(im3d[ydim-1, :, :])))
     border_seg_ids.update(set(np.unique(im3d[:, xdim-1, :])))
+    return border_seg_ids
 
-    # Remove those segments.
-    for i in border_seg_ids:
-        im3d[im3d == i] = 0
 
-    return im3d
+def cells_selected_by(im3d, selectors):
+    """Return union of the identifiers picked out by all the selectors.
 
+    A selector is a function that takes the segmentation and returns an
+    iterable of identifiers to remove from it.
+    """
+    ids_to_filter = set()
+    for selector in selectors:
+        ids_to_filter.update(int(i) for i in selector(im3d))
+    return ids_to_filter
 
-def segment(stack):
-    """Segment the stack into 3D regions representing cells."""
-    mask = threshold_otsu(stack)
-    mask = remove_small_objects_in_plane(mask, min_size=1000)
-    mask = pseudo_convex_hull(mask)
+
+@transformation
+@profiled
+def filter_segmentations(im3d, selectors):
+    """Remove all segments picked out by the selectors in a single pass."""
+    return drop_labels(im3d, cells_selected_by(im3d, selectors))
+
+
+def generate_mask(stack, hull="plane"):
+    """Return mask of the root generated from the cell wall stack.
+
+    hull is "plane" for the convex hull of each z-slice or "3d" for the
+    convex hull of the whole root.
+    """
+    return root_mask(stack, 1000, hull)
+
+
+def preprocess(stack):
+    """Return smoothed gradient image to be segmented by the watershed."""
     stack = identity(stack)
-    stack = filter_median(stack)
-    stack = gradient_magnitude(stack)
-    stack = discrete_gaussian_filter(stack, 2.0)
-    stack = morphological_watershed(stack, 0.664)
+    return smoothed_gradient_magnitude(stack, 2.0)
+
+
+def segment_preprocessed(stack, mask, level=0.664):
+    """Segment a preprocessed stack into 3D regions representing cells."""
+    stack = morphological_watershed(stack, level)
+    return filter_segmented(stack, mask)
+
+
+def filter_segmented(stack, mask):
+    """Remove segments outside the mask or touching the image border."""
     identity(stack.view(PrettyColorImage3D))
-    stack = filter_cells_outside_mask(stack, mask)
-    stack = remove_border_segmentations(stack)
+    stack = filter_segmentations(stack,
+                                 [lambda im: cells_outside_mask(im, mask),
+                                  cells_touching_border])
     identity(stack.view(PrettyColorImage3D))
     return stack
+
+
+def segment(stack, level=0.664, hull="plane"):
+    """Segment the stack into 3D regions representing cells."""
+    mask = generate_mask(stack, hull)
+    stack = preprocess(stack)
+    return segment_preprocessed(stack, mask, level)
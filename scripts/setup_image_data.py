@@ -5,8 +5,19 @@ import errno
 import argparse
 
 from pprint import pprint
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
 
 from jicbioimage.core.io import DataManager, FileBackend
+from jicbioimage.core.image import Image3D
+
+from manifest import create_manifest, is_current
+from backend import (
+    backend_directory,
+    hash_cache_fpath,
+    load_microscopy_collection,
+)
 
 def mkdir_p(path):
     try:
@@ -18,19 +29,93 @@ def mkdir_p(path):
 
 
 def get_data_manager(output_directory):
-    """Return FileBackend instance."""
+    """Return FileBackend instance.
 
-    backend_dir = os.path.join(output_directory, '.backend')
+    Use backend.load_microscopy_collection to load files, which makes sure
+    that concurrent processes unpack each file only once.
+    """
+
+    backend_dir = backend_directory(output_directory)
     if not os.path.isdir(backend_dir):
         os.mkdir(backend_dir)
     backend = FileBackend(backend_dir)
     return DataManager(backend)
 
-def is_directory_processed(output_directory):
+def _read_plane(task):
+    stack, index, proxy = task
+    stack[index] = proxy.image
+
 
-    return False
+def zstack_channels(microscopy_collection, s=0, channels=(0, 1), t=0,
+                    low_memory=False, threads=None):
+    """Return dictionary mapping channels to z-stacks read in one pass.
 
-def unpack_series_in_single_file(filename, output_directory):
+    The proxies of all the planes are found in a single pass over the
+    collection and the planes are read in parallel by a pool of threads.
+    The z-stacks are views of one contiguous (channel, y, x, z) array. If
+    low_memory is True the array is a copy on write memory map of a .npy
+    file next to the backend TIFF files, which is reused by later calls.
+    The planes are copied into it one at a time, so that the stack is never
+    assembled in memory. Planes without a backend file, such as those of
+    phantom.PhantomCollection, are always read into memory.
+    """
+    channels = list(channels)
+    proxies = dict((c, []) for c in channels)
+    for proxy in microscopy_collection:
+        if proxy.series == s and proxy.timepoint == t \
+                and proxy.channel in proxies:
+            proxies[proxy.channel].append(proxy)
+    for plane_proxies in proxies.values():
+        plane_proxies.sort(key=lambda p: p.zslice)
+
+    fpath = None
+    backend_fpath = proxies[channels[0]][0].fpath
+    if low_memory and backend_fpath is not None:
+        fpath = os.path.join(os.path.dirname(backend_fpath),
+                             "S{}_C{}_T{}.npy".format(
+                                 s, "-".join(str(c) for c in channels), t))
+    if fpath is None or not os.path.isfile(fpath):
+        first = np.asarray(proxies[channels[0]][0].image)
+        shape = (len(channels),) + first.shape + \
+            (len(proxies[channels[0]]),)
+        if fpath is None:
+            stack = np.empty(shape, dtype=first.dtype)
+        else:
+            tmp_fpath = "{}.{}.tmp".format(fpath, os.getpid())
+            stack = np.lib.format.open_memmap(tmp_fpath, mode="w+",
+                                              dtype=first.dtype, shape=shape)
+        del first
+
+        tasks = [(stack, (i, slice(None), slice(None), z), proxy)
+                 for i, c in enumerate(channels)
+                 for z, proxy in enumerate(proxies[c])]
+        pool = ThreadPool(threads)
+        try:
+            pool.map(_read_plane, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        if fpath is not None:
+            stack.flush()
+            del stack
+            os.rename(tmp_fpath, fpath)
+    if fpath is not None:
+        stack = np.load(fpath, mmap_mode="c")
+
+    return dict((c, stack[i].view(Image3D)) for i, c in enumerate(channels))
+
+def is_directory_processed(output_directory, expected_manifest):
+    """Return True if the directory holds complete and current output.
+
+    Output is complete if the analysis wrote a completion manifest, and
+    current if that manifest matches the expected one, i.e. the input file,
+    pipeline version and parameters are unchanged.
+    """
+    return is_current(output_directory, expected_manifest)
+
+def unpack_series_in_single_file(filename, output_directory, version=None,
+                                 parameters=None):
     """Unpack the series contained in a particular image file. Returns
 
     backend_dir_path, (image_filename, series_identifier, output_path)
@@ -40,10 +125,20 @@ def unpack_series_in_single_file(filename, output_directory):
     image_filename is the name of the image file passed in to the function
     series_identifier is the numerical identifier of the series, from 0 onwards
     output_path is target directory for analysed data from the series.
+
+    Series whose output directory is complete and current for the given
+    pipeline version and parameters, by default those of analyse_series, are
+    left out of the list.
     """
+    if version is None or parameters is None:
+        import analyse_series
+        if version is None:
+            version = analyse_series.__version__
+        if parameters is None:
+            parameters = analyse_series.DEFAULT_PARAMETERS
 
-    data_manager = get_data_manager(output_directory)
-    microscopy_collection = data_manager.load(filename)
+    microscopy_collection = load_microscopy_collection(filename,
+                                                       output_directory)
 
     file_basename = os.path.basename(filename)
     file_output_directory = os.path.join(output_directory, file_basename)
@@ -57,7 +152,11 @@ def unpack_series_in_single_file(filename, output_directory):
         series_output_directory = os.path.join(file_output_directory, series_name)
         mkdir_p(series_output_directory)
 
-        if not is_directory_processed(series_output_directory):
+        expected_manifest = create_manifest(
+            filename, sid, version, parameters,
+            hash_cache_fpath(output_directory))
+        if not is_directory_processed(series_output_directory,
+                                      expected_manifest):
             process_list.append((filename, sid, series_output_directory))
 
     return output_directory, process_list
@@ -0,0 +1,222 @@
+"""Write stacks of z-slice images to disk in parallel.
+
+The z-slices are rendered in the calling thread and handed to a pool of
+threads, or processes, that encode them as PNG or uncompressed TIFF and write
+them to disk. The number of slices that have been rendered but not yet
+written is bounded so that memory use does not grow with the stack depth.
+
+The format, PNG compression level and pool are configured via
+StackWriterConfig:
+
+    StackWriterConfig.format = "tiff"
+    StackWriterConfig.workers = 8
+
+Every write returns per-slice timings, in seconds, of the rendering,
+encoding and writing, so that the I/O cost can be inspected.
+"""
+
+import os
+import time
+import zlib
+import struct
+import logging
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+FORMAT_EXTENSIONS = {"png": ".png", "tiff": ".tif"}
+
+
+class StackWriterConfig(object):
+    """Stack writer configuration."""
+    format = "png"
+    compression_level = 6
+    workers = None
+    processes = False
+    max_in_flight = None
+
+
+def _png_chunk(chunk_type, data):
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", crc)
+
+
+def encode_png(array, compression_level=6):
+    """Return PNG encoding of 2D grey or 3D RGB(A) uint8 array."""
+    array = np.asarray(array, dtype=np.uint8)
+    height, width = array.shape[:2]
+    channels = 1 if array.ndim == 2 else array.shape[2]
+    color_type = {1: 0, 3: 2, 4: 6}[channels]
+
+    # Every scanline starts with filter type 0 (None).
+    raw = np.zeros((height, 1 + width * channels), dtype=np.uint8)
+    raw[:, 1:] = array.reshape(height, width * channels)
+
+    header = struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)
+    return b"".join([b"\x89PNG\r\n\x1a\n",
+                     _png_chunk(b"IHDR", header),
+                     _png_chunk(b"IDAT", zlib.compress(raw.tobytes(),
+                                                       compression_level)),
+                     _png_chunk(b"IEND", b"")])
+
+
+def encode_tiff(array):
+    """Return uncompressed baseline TIFF encoding of uint8 array.
+
+    Samples beyond the grey or RGB ones, e.g. the second of two channels,
+    are declared as unspecified extra samples.
+    """
+    array = np.ascontiguousarray(array, dtype=np.uint8)
+    height, width = array.shape[:2]
+    channels = 1 if array.ndim == 2 else array.shape[2]
+    data = array.tobytes()
+    photometric = 2 if channels >= 3 else 1
+    extra = channels - (3 if channels >= 3 else 1)
+
+    num_tags = 11 if extra else 10
+    ifd_offset = 8
+    values_offset = ifd_offset + 2 + num_tags * 12 + 4
+    values = []
+
+    def short(tag, value, count=1):
+        return struct.pack("<HHIHH", tag, 3, count, value, 0)
+
+    def long_(tag, value):
+        return struct.pack("<HHII", tag, 4, 1, value)
+
+    def shorts(tag, items):
+        # Up to two shorts fit in the entry, longer arrays are stored
+        # after the directory.
+        if len(items) <= 2:
+            packed = struct.pack("<" + "H" * len(items), *items)
+            return struct.pack("<HHI", tag, 3, len(items)) + \
+                packed.ljust(4, b"\x00")
+        offset = values_offset + sum(len(v) for v in values)
+        values.append(struct.pack("<" + "H" * len(items), *items))
+        return struct.pack("<HHII", tag, 3, len(items), offset)
+
+    bits_per_sample = shorts(258, [8] * channels)
+    extra_samples = shorts(338, [0] * extra) if extra else None
+    data_offset = values_offset + sum(len(v) for v in values)
+
+    entries = [long_(256, width),
+               long_(257, height),
+               bits_per_sample,
+               short(259, 1),
+               short(262, photometric),
+               long_(273, data_offset),
+               short(277, channels),
+               long_(278, height),
+               long_(279, len(data)),
+               short(284, 1)]
+    if extra_samples is not None:
+        entries.append(extra_samples)
+    return b"".join([b"II*\x00",
+                     struct.pack("<I", ifd_offset),
+                     struct.pack("<H", num_tags),
+                     b"".join(entries),
+                     struct.pack("<I", 0),
+                     b"".join(values),
+                     data])
+
+
+def encode(array, fmt, compression_level):
+    """Return array encoded in the given format."""
+    if fmt == "png":
+        return encode_png(array, compression_level)
+    if fmt == "tiff":
+        return encode_tiff(array)
+    raise(ValueError("Unknown stack format: {}".format(fmt)))
+
+
+def _encode_and_write(array, fpath, fmt, compression_level):
+    """Encode and write array; return (encode, write) times."""
+    start = time.time()
+    data = encode(array, fmt, compression_level)
+    encoded = time.time()
+    with open(fpath, "wb") as fh:
+        fh.write(data)
+    return encoded - start, time.time() - encoded
+
+
+def zslice_fname(z, num_digits):
+    """Return file name for z-slice without extension."""
+    return "z{}".format(str(z).zfill(num_digits))
+
+
+def write_zslices(zdim, render, config=StackWriterConfig):
+    """Render and write z-slices in parallel.
+
+    render(z) returns a list of (fpath, array) tuples for z-slice z, where
+    fpath excludes the file extension, which is determined by the format.
+
+    Returns list of per-slice timing dictionaries.
+    """
+    fmt = config.format
+    ext = FORMAT_EXTENSIONS[fmt]
+    workers = config.workers or multiprocessing.cpu_count()
+    max_in_flight = config.max_in_flight or 2 * workers
+    if config.processes:
+        pool = multiprocessing.Pool(workers)
+    else:
+        pool = ThreadPool(workers)
+
+    timings = []
+    pending = collections.deque()
+
+    def collect():
+        timing, result = pending.popleft()
+        timing["encode"], timing["write"] = result.get()
+        timings.append(timing)
+
+    try:
+        for z in range(zdim):
+            start = time.time()
+            outputs = render(z)
+            render_time = time.time() - start
+            for fpath, array in outputs:
+                while len(pending) >= max_in_flight:
+                    collect()
+                fpath = fpath + ext
+                result = pool.apply_async(_encode_and_write,
+                                          (array, fpath, fmt,
+                                           config.compression_level))
+                timing = {"z": z, "fpath": fpath, "render": render_time}
+                pending.append((timing, result))
+        while pending:
+            collect()
+    finally:
+        pool.close()
+        pool.join()
+
+    if timings:
+        logging.debug("Wrote {} slices: render {:.2f}s, encode {:.2f}s, "
+                      "write {:.2f}s".format(
+                          len(timings),
+                          sum(t["render"] for t in timings),
+                          sum(t["encode"] for t in timings),
+                          sum(t["write"] for t in timings)))
+    return timings
+
+
+def write_stack(stack, directory, to_rgb=None, config=StackWriterConfig):
+    """Write (ydim, xdim, zdim) stack to directory as z-slice images.
+
+    If given, to_rgb is applied to each z-slice before it is encoded.
+    Returns list of per-slice timing dictionaries.
+    """
+    if not os.path.isdir(directory):
+        os.mkdir(directory)
+    zdim = stack.shape[2]
+    num_digits = len(str(max(zdim - 1, 0)))
+
+    def render(z):
+        zslice = np.asarray(stack[:, :, z])
+        if to_rgb is not None:
+            zslice = to_rgb(zslice)
+        fpath = os.path.join(directory, zslice_fname(z, num_digits))
+        return [(fpath, zslice)]
+
+    return write_zslices(zdim, render, config)
@@ -0,0 +1,161 @@
+"""Compare segmentations of a series across watershed levels and cell sizes.
+
+The preprocessing (mask generation, median, gradient magnitude and Gaussian
+filters) is run once. The watershed and filtering are then run for every
+level in parallel, and every combination of level and cell size bounds is
+summarised in a comparison table written to sweep.csv.
+"""
+
+import os
+import logging
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from jicbioimage.core.io import AutoWrite
+
+from backend import load_microscopy_collection
+from segment import (
+    set_itk_threads,
+    generate_mask,
+    preprocess,
+    segment_preprocessed,
+)
+from cellinfo import cellinfo
+from filter_real_cells import real_cells
+from analyse_series import DEFAULT_PARAMETERS, load_channels
+
+SWEEP_FNAME = "sweep.csv"
+
+COLUMNS = ("watershed_level",
+           "min_cell_size",
+           "max_cell_size",
+           "num_cells",
+           "mean_intensity_mean",
+           "mean_intensity_median",
+           "mean_intensity_std",
+           "mean_intensity_p10",
+           "mean_intensity_p90",
+           "total_intensity_mean",
+           "total_intensity_median")
+
+# Images shared with the worker processes, set by the pool initializer.
+_SHARED = {}
+
+
+def _init_worker(itk_threads, shared):
+    """Configure a freshly started worker process.
+
+    The images reach the workers as initializer arguments, which forked
+    workers inherit without copying and spawned workers unpickle once.
+    """
+    AutoWrite.on = False
+    set_itk_threads(itk_threads)
+    _SHARED.update(shared)
+
+
+def _segment_level(level):
+    """Return (level, cellinfo) for the shared preprocessed images."""
+    segmentation = segment_preprocessed(_SHARED["preprocessed"],
+                                        _SHARED["mask"],
+                                        level)
+    return level, cellinfo(_SHARED["intensity"], segmentation)
+
+
+def summarise(info, level, min_size, max_size):
+    """Return comparison table row for one combination of settings."""
+    cells = [p for p in info if real_cells(p, min_size, max_size)]
+    total = np.array([p["total_intensity"] for p in cells], dtype=float)
+    voxels = np.array([p["voxels"] for p in cells], dtype=float)
+    mean = total / voxels if len(cells) else total
+
+    def stat(func, values):
+        return float(func(values)) if len(values) else float("nan")
+
+    return (level, min_size, max_size, len(cells),
+            stat(np.mean, mean),
+            stat(np.median, mean),
+            stat(np.std, mean),
+            stat(lambda v: np.percentile(v, 10), mean),
+            stat(lambda v: np.percentile(v, 90), mean),
+            stat(np.mean, total),
+            stat(np.median, total))
+
+
+def sweep(microscopy_collection, series, levels, min_sizes, max_sizes,
+          workers=None):
+    """Return list of comparison table rows."""
+    stack, intensity_stack = load_channels(microscopy_collection, series)
+    shared = {"mask": generate_mask(stack),
+              "preprocessed": preprocess(stack),
+              "intensity": intensity_stack}
+    del stack
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    workers = min(workers, len(levels))
+    itk_threads = max(1, multiprocessing.cpu_count() // workers)
+    pool = multiprocessing.Pool(processes=workers, initializer=_init_worker,
+                                initargs=(itk_threads, shared))
+    try:
+        infos = dict(pool.map(_segment_level, levels))
+    finally:
+        pool.close()
+        pool.join()
+
+    rows = []
+    for level, min_size, max_size in itertools.product(levels, min_sizes,
+                                                       max_sizes):
+        rows.append(summarise(infos[level], level, min_size, max_size))
+    return rows
+
+
+def write_table(rows, fpath):
+    """Write comparison table to CSV file."""
+    with open(fpath, "w") as fh:
+        fh.write(",".join(COLUMNS) + "\n")
+        for row in rows:
+            fh.write(",".join(str(v) for v in row) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("input_source", help="Input file")
+    parser.add_argument("series", type=int, help="series identifier")
+    parser.add_argument("output_dir", help="Output directory")
+    parser.add_argument("--levels", type=float, nargs="+",
+                        default=[DEFAULT_PARAMETERS["watershed_level"]],
+                        help="Watershed levels")
+    parser.add_argument("--min-sizes", type=int, nargs="+",
+                        default=[DEFAULT_PARAMETERS["min_cell_size"]],
+                        help="Minimum cell sizes in voxels")
+    parser.add_argument("--max-sizes", type=int, nargs="+",
+                        default=[DEFAULT_PARAMETERS["max_cell_size"]],
+                        help="Maximum cell sizes in voxels")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of worker processes")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.input_source):
+        parser.error("{} not a file".format(args.input_source))
+
+    if not os.path.isdir(args.output_dir):
+        os.mkdir(args.output_dir)
+
+    AutoWrite.on = False
+    logging.basicConfig(level=logging.INFO)
+
+    microscopy_collection = load_microscopy_collection(args.input_source,
+                                                       args.output_dir)
+    rows = sweep(microscopy_collection, args.series, args.levels,
+                 args.min_sizes, args.max_sizes, args.workers)
+
+    fpath = os.path.join(args.output_dir, SWEEP_FNAME)
+    write_table(rows, fpath)
+    logging.info("Wrote comparison table: {}".format(fpath))
+
+
+if __name__ == "__main__":
+    main()
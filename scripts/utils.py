@@ -1,55 +1,69 @@
 """Utility functions."""
 
 import os
+import json
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import skimage.io
 
-from jicbioimage.core.util.array import unique_color_array, pretty_color_array
-from jicbioimage.core.util.color import identifier_from_unique_color
-from jicbioimage.core.image import _sorted_listdir, Image, Image3D
+from jicbioimage.core.util.array import pretty_color_array
+from jicbioimage.core.image import _sorted_listdir, Image3D
+
+from labelvolume import (
+    LABEL_VOLUME_EXT,
+    LabelVolume,
+    write_label_volume,
+    is_label_volume,
+)
+from stackwriter import write_stack
+
+MAX_UNIQUE_COLOR_IDENTIFIER = 256**3 - 1
+
+
+def unique_color_array(array):
+    """Return RGB array encoding each identifier as a unique colour.
+
+    Vectorised equivalent of jicbioimage's unique_color_array: the identifier
+    is packed into the red, green and blue channels with array arithmetic.
+    """
+    array = np.asarray(array)
+    if array.size and (array.min() < 0
+                       or array.max() > MAX_UNIQUE_COLOR_IDENTIFIER):
+        raise ValueError("Identifiers must be between 0 and {}".format(
+            MAX_UNIQUE_COLOR_IDENTIFIER))
+    identifiers = array.astype(np.uint32)
+    rgb = np.empty(array.shape + (3,), dtype=np.uint8)
+    rgb[..., 0] = identifiers >> 16
+    rgb[..., 1] = (identifiers >> 8) & 255
+    rgb[..., 2] = identifiers & 255
+    return rgb
+
+
+def identifier_array(rgb):
+    """Return identifier array decoded from unique colour RGB(A) array."""
+    rgb = rgb.astype(np.uint64)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
 
 class PrettyColorImage3D(Image3D):
     def to_directory(self, directory):
-        if not os.path.isdir(directory):
-            os.mkdir(directory)
-        xdim, ydim, zdim = self.shape
-        num_digits = Image3D._num_digits(zdim-1)
-        for z in range(zdim):
-            num = str(z).zfill(num_digits)
-            fname = "z{}.png".format(num)
-            fpath = os.path.join(directory, fname)
-            with open(fpath, "wb") as fh:
-                im = Image.from_array(pretty_color_array(self[:, :, z]))
-                fh.write(im.png())
+        return write_stack(self, directory, pretty_color_array)
 
 class ColorImage3D(Image3D):
     def to_directory(self, directory):
-        if not os.path.isdir(directory):
-            os.mkdir(directory)
-        xdim, ydim, zdim = self.shape
-        num_digits = Image3D._num_digits(zdim-1)
-        for z in range(zdim):
-            num = str(z).zfill(num_digits)
-            fname = "z{}.png".format(num)
-            fpath = os.path.join(directory, fname)
-            with open(fpath, "wb") as fh:
-                im = Image.from_array(unique_color_array(self[:, :, z]))
-                fh.write(im.png())
+        return write_stack(self, directory, unique_color_array)
 
     @staticmethod
     def _rgb_to_identifier(array):
-        ydim, xdim, zdim = array.shape
-        id_array = np.zeros((ydim, xdim), dtype=np.uint64)
-
-        for y in range(ydim):
-            for x in range(xdim):
-                id_array[y, x] = identifier_from_unique_color(array[y, x])
-
-        return id_array
+        return identifier_array(array)
 
     @classmethod
-    def from_directory(cls, directory):
+    def from_directory(cls, directory, threads=None):
+        """Return stack read from directory of unique colour z-slices.
+
+        The z-slices are read and decoded on a pool of threads.
+        """
         skimage.io.use_plugin('freeimage')
 
         def is_image_fname(fname):
@@ -61,7 +75,61 @@ class ColorImage3D(Image3D):
                   if is_image_fname(fn)]
         fpaths = [os.path.join(directory, fn) for fn in fnames]
 
-        images = [cls._rgb_to_identifier(skimage.io.imread(fp))
-                  for fp in fpaths]
+        def read_zslice(fpath):
+            return cls._rgb_to_identifier(skimage.io.imread(fpath))
+
+        pool = ThreadPool(threads)
+        try:
+            images = pool.map(read_zslice, fpaths)
+        finally:
+            pool.close()
+            pool.join()
         stack = np.dstack(images)
         return stack.view(cls)
+
+    def to_label_volume(self, fpath, cellinfo=None):
+        write_label_volume(fpath, self, cellinfo)
+
+    @classmethod
+    def from_label_volume(cls, fpath, zstart=None, zstop=None):
+        """Return stack, or z-range of it, read from a label volume file."""
+        volume = LabelVolume(fpath)
+        try:
+            if zstart is None and zstop is None:
+                stack = volume.read()
+            else:
+                zstart = 0 if zstart is None else zstart
+                zstop = volume.shape[2] if zstop is None else zstop
+                stack = volume.read_zrange(zstart, zstop)
+        finally:
+            volume.close()
+        return stack.view(cls)
+
+
+def load_istack(path):
+    """Return (cells, cellinfo) from istack directory or label volume file."""
+    if is_label_volume(path):
+        volume = LabelVolume(path)
+        try:
+            cells = volume.read().view(ColorImage3D)
+            cellinfo = volume.cellinfo
+        finally:
+            volume.close()
+        return cells, cellinfo
+
+    with open(os.path.join(path, "cellinfo.json")) as fh:
+        cellinfo = json.load(fh)
+    return ColorImage3D.from_directory(path), cellinfo
+
+
+def save_istack(cells, cellinfo, path):
+    """Write cells and cellinfo to istack directory or label volume file.
+
+    A label volume is written if path has the label volume extension.
+    """
+    if path.endswith(LABEL_VOLUME_EXT):
+        write_label_volume(path, cells, cellinfo)
+        return
+    cells.view(ColorImage3D).to_directory(path)
+    with open(os.path.join(path, "cellinfo.json"), "w") as fh:
+        json.dump(cellinfo, fh, indent=2)